@@ -4,6 +4,8 @@ from collections import defaultdict
 from logging.handlers import SMTPHandler
 import base64
 import binascii
+import hashlib
+import json
 import logging
 import math
 import re
@@ -12,10 +14,14 @@ import sys
 import time
 
 import click
-from flask import Flask, render_template, session, redirect, url_for, request, g, flash, send_from_directory, abort, send_file, request
+from flask import Flask, render_template, session, redirect, url_for, request, g, flash, send_from_directory, abort, send_file, request, make_response, jsonify
 
 from board.util import *
-from board import teaminfo, materials, gradeupload, taskadmin, sshkeys, tasks, users, autograde, presentations, tutorials, eastereggs, booking, timesheet
+from board import queryplans
+from board.scoreboard import record_solve, rebuild_scoreboard, bump_scoreboard_version, get_scoreboard_snapshot
+from board.taskstats import check_task_stats, rebuild_task_stats
+from board.submissions import migrate_submissions
+from board import teaminfo, materials, gradeupload, taskadmin, sshkeys, tasks, users, autograde, presentations, tutorials, eastereggs, booking, timesheet, profiler
 
 try:
     import config
@@ -41,6 +47,7 @@ app.register_blueprint(tutorials.bp)
 app.register_blueprint(booking.bp)
 app.register_blueprint(eastereggs.bp)
 app.register_blueprint(timesheet.bp)
+app.register_blueprint(profiler.bp)
 
 @click.group()
 def cli():
@@ -59,9 +66,6 @@ for plugin_pkg in app.config["PLUGINS"]:
     if register_cli:
         register_cli(cli)
 
-#from werkzeug.middleware.profiler import ProfilerMiddleware
-#app.wsgi_app = ProfilerMiddleware(app.wsgi_app)
-
 @app.errorhandler(404)
 def page_not_found(e):
     # note that we set the 404 status explicitly
@@ -108,9 +112,7 @@ if app.config.get("EMAIL_BUGS", False) == True:
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    release_db()
 
 @app.before_request
 def check_maintenance():
@@ -131,8 +133,7 @@ if not app.config.get("DISABLE_ACTIVITY_LOG"):
     @app.before_request
     def log_activity():
         if is_logged_in():
-            cur = get_db().cursor()
-            cur.execute("UPDATE users SET last_active = strftime('%s','now') WHERE id = ?", [session['user-id']])
+            record_activity(session['user-id'])
 
 @app.after_request
 def set_security_headers(response):
@@ -155,46 +156,22 @@ def index():
 @app.route("/scoreboard")
 @login_required
 def scoreboard():
-    # Replay submission log
     cur = get_db().cursor()
-    #cur.execute("SELECT task_id, u.vorname || ' ' || u.nachname as user FROM flag_submissions LEFT JOIN users u ON u.id = user_id ORDER BY flag_time")
-
-    # Fetch number of tasks
-    cur.execute("SELECT task_id, task_short FROM tasks WHERE from_date < strftime('%s','now') ORDER BY order_num")
-    tasks = [r for r in cur.fetchall()]
-
-    cur.execute("SELECT s.task_id, s.team_id FROM flag_submissions s LEFT JOIN teams t ON s.team_id = t.team_id WHERE t.deleted IS NULL ORDER BY flag_time")
-
-    task_ctr = {k["task_id"]: 1 for k in tasks}
-    state = defaultdict(lambda: {k["task_id"]: 0 for k in tasks})
-
-    for r in cur.fetchall():
-        cur_state = state[r["team_id"]]
-        if cur_state[r["task_id"]] == 0:
-            cur_state[r["task_id"]] = task_ctr[r["task_id"]]
-            task_ctr[r["task_id"]] += 1
-
-    # Sort
-    sorted_state = sorted(
-        [(k, v, sum(v.values()), sum(1 for x in v.values() if x > 0)) for k, v in state.items()],
-        key=lambda x: (-x[3], x[2])
-    )   
-    #print([(k,sum(v),v) for k,v in sorted_state])
-
-    teams = None
-    cur.execute("""SELECT
-    t.team_id,
-    CASE WHEN tt.teamname IS NULL THEN 'Team ' || tt.team_id ELSE tt.teamname END as teamname,
-    GROUP_CONCAT(u.vorname || ' ' || u.nachname, ', ') as member
-    FROM team_members t
-    LEFT JOIN users u ON u.id = t.member_id
-    LEFT JOIN teams tt ON t.team_id = tt.team_id
-    WHERE tt.deleted IS NUll
-    GROUP BY t.team_id""")
-    teams = {res['team_id']: res for res in cur.fetchall()}
+    snapshot = get_scoreboard_snapshot()
 
     show_names_in_scoreboard = is_admin() or app.config["SHOW_NAMES_TO_ALL"]
 
+    # Pages with flashed messages or the feedback form are one-off; everything else only depends on
+    # the scoreboard snapshot and on who is looking at it, so auto-refreshing browsers can get a 304.
+    etag = None
+    if "last-solved" not in session and "_flashes" not in session:
+        etag_data = [snapshot["id"], session.get("user-id"), session.get("user-role"), session.get("user-displayname"), session.get("user-matrikel"), show_names_in_scoreboard]
+        etag = hashlib.sha256(json.dumps(etag_data).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
     feedback_data = None
     if "last-solved" in session:
         task_id = session["last-solved"]
@@ -212,7 +189,32 @@ def scoreboard():
                 "url": f"/tasks/{task_id}/feedback"
             }
 
-    return render_template("scoreboard.html", scoreboard=sorted_state, teams=teams, tasks=tasks, show_names=show_names_in_scoreboard, feedback_data=feedback_data)
+    response = make_response(render_template("scoreboard.html", scoreboard=snapshot["scoreboard"], teams=snapshot["teams"], tasks=snapshot["tasks"], fragment=snapshot["fragment"], show_names=show_names_in_scoreboard, feedback_data=feedback_data))
+    if etag:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+@app.route("/scoreboard.json")
+@login_required
+def scoreboard_json():
+    snapshot = get_scoreboard_snapshot()
+    task_short = {t["task_id"]: t["task_short"] for t in snapshot["tasks"]}
+    response = jsonify({
+        "tasks": list(task_short.values()),
+        "scoreboard": [{
+            "rank": rank,
+            "team": snapshot["teams"][team_id]["teamname"] if team_id in snapshot["teams"] else f"Team {team_id}",
+            "score": score,
+            "solved": solved,
+            "solves": {task_short[k]: v for k, v in state.items() if v > 0}
+        } for rank, (team_id, state, score, solved) in enumerate(snapshot["scoreboard"], 1)]
+    })
+    response.set_etag(snapshot["id"])
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route("/lookup")
 @tutor_required
@@ -249,7 +251,7 @@ def flag():
     cur.execute("SELECT * FROM easteregg_flags WHERE flag = ?", (flag,))
     if m := cur.fetchone():
         # Updated accessed counter
-        cur.execute("UPDATE easteregg_flags SET counter=counter+1 WHERE easteregg_id=?", (m['easteregg_id'],))
+        queue_write("UPDATE easteregg_flags SET counter=counter+1 WHERE easteregg_id=?", (m['easteregg_id'],))
 
         # Redirect user to target
         return redirect(m['link'])
@@ -261,9 +263,7 @@ def flag():
         data = cur.fetchone()
 
         # Check if task is already available
-        cur.execute("SELECT * FROM tasks WHERE task_id=?", [fdec['task_id']])
-        task_data = cur.fetchone()
-        if task_data['from_date'] > (fdec['ftime'] / 1e6):
+        if fdec['from_date'] > (fdec['ftime'] / 1e6):
             flash("You are really fast! The task which created this flag hasn't even been released so far. Please wait until it started and submit a new flag then!")
             return redirect("/scoreboard")
 
@@ -276,7 +276,9 @@ def flag():
                 log_event(session["user-id"], Category.STUDENT_INCIDENT, f"User {session['user-id']} on team {team} submitted flag {flag} for task {fdec['task_id']} previously submitted by user {data['user_id']} on team {data['team_id']}")
                 flash("We already got this flag submitted by another team! Flag sharing is forbidden!")
         else:
-            cur.execute("INSERT INTO flag_submissions (flag, team_id, user_id, task_id, submission_time, flag_time) VALUES (?,?,?,?,strftime('%s','now'),?)", (flag, team_id, session["user-id"], fdec["task_id"], fdec["ftime"]))
+            with transaction() as cur:
+                cur.execute("INSERT INTO flag_submissions (flag, team_id, user_id, task_id, submission_time, flag_time) VALUES (?,?,?,?,strftime('%s','now'),?)", (flag, team_id, session["user-id"], fdec["task_id"], fdec["ftime"]))
+                record_solve(cur, team_id, fdec["task_id"], fdec["ftime"])
             flash("Looks like a flag! Congratz!", "success")
             session["last-solved"] = fdec["task_id"]
     else:
@@ -410,6 +412,7 @@ def team_changename():
         return redirect("/team")
 
     cur.execute("UPDATE teams SET teamname =? WHERE team_id=?", [new_name, get_team_from_db()])
+    bump_scoreboard_version(cur)
     return redirect("/team")
 
 @app.route("/comments")
@@ -622,6 +625,82 @@ def create_db():
 def upgrade_db():
     init_db()
 
+@cli.command("rebuild-scoreboard")
+def rebuild_scoreboard_cmd():
+    """Recompute the materialized scoreboard from the flag submission log"""
+    rebuild_scoreboard()
+
+@cli.command("migrate-submissions")
+@click.option("--dry-run", is_flag=True, help="Only report what would be moved")
+def migrate_submissions_cmd(dry_run):
+    """Move submission files into the content-addressed store, deduplicating identical files"""
+    files = duplicates = saved = 0
+    for path, digest, duplicate, size in migrate_submissions(dry_run):
+        if digest is None:
+            print(f"{path}: not found, skipped")
+            continue
+        files += 1
+        if duplicate:
+            duplicates += 1
+            saved += size
+    print(f"{files} files {'would be ' if dry_run else ''}moved, {duplicates} duplicates, {saved / 2**20:.1f} MiB saved")
+
+@cli.command("check-task-stats")
+@click.option("--fix", is_flag=True, help="Recompute all counters if any of them is off")
+def check_task_stats_cmd(fix):
+    """Compare the per-task counters in task_stats with the submission, grading and feedback tables"""
+    problems = check_task_stats()
+    for task_id, stored, expected in problems:
+        print(f"Task {task_id}: stored {stored}, expected {expected}")
+    print(f"{len(problems)} tasks with wrong counters")
+    if problems and fix:
+        rebuild_task_stats()
+        print("Counters rebuilt")
+
+@cli.command()
+@click.option("--batch-size", default=10000, show_default=True, help="Number of flags read and decrypted per batch")
+def validate_flags(batch_size):
+    """Re-validate all submitted flags and report invalid, out-of-window and cross-task flags"""
+    start = time.monotonic()
+    cur = get_db().cursor()
+    cur.execute("SELECT rowid, flag, task_id, team_id, submission_time FROM flag_submissions")
+    total = 0
+    problems = 0
+    while rows := cur.fetchmany(batch_size):
+        total += len(rows)
+        results = check_flags_bulk(r["flag"] for r in rows)
+        for r in rows:
+            result, details = results[r["flag"]]
+            if result is None:
+                problem = f"invalid: {details}"
+            elif result["task_id"] != r["task_id"]:
+                problem = f"cross-task: flag is for task {result['task_id']} / {result['task_short']}, but recorded for task {r['task_id']}"
+            elif result["ftime"] / 1e6 < result["from_date"] or result["ftime"] / 1e6 > r["submission_time"] + 1:
+                problem = f"out of window: flag created at {datetime_filter(result['ftime'] // 1e6)}, task released {datetime_filter(result['from_date'])}, submitted {datetime_filter(r['submission_time'])}"
+            else:
+                continue
+            problems += 1
+            print(f"Submission {r['rowid']} (team {r['team_id']}, flag {r['flag']}): {problem}")
+    print(f"Checked {total} flags in {time.monotonic() - start:.2f}s, {problems} problematic")
+
+@cli.command()
+@click.option("--live", is_flag=True, help="Explain against the configured database and its statistics instead of a fresh schema")
+@click.option("--ignore-table", multiple=True, help="Don't report scans of this table (repeatable); small lookup tables are ignored anyway")
+@click.option("--fail-on-scan", is_flag=True, help="Exit with status 1 if any statement scans a table")
+def check_query_plans(live, ignore_table, fail_on_scan):
+    """Run EXPLAIN QUERY PLAN on all SQL statements in app.py and board/ and report full table scans"""
+    db = get_db() if live else queryplans.create_schema()
+    problems = queryplans.check_query_plans(db, queryplans.default_paths(), queryplans.SMALL_TABLES + list(ignore_table))
+    scans = 0
+    for filename, line, sql, problem in problems:
+        print(f"{filename}:{line}: {problem}")
+        if sql is not None:
+            scans += 1
+            print("    " + " ".join(sql.split())[:200])
+    print(f"{scans} statements with problems, {len(problems) - scans} dynamic statements skipped")
+    if fail_on_scan and scans:
+        sys.exit(1)
+
 @cli.command()
 @click.argument("email")
 @click.argument("firstname")
@@ -636,26 +715,11 @@ def create_user(email, firstname, name, matrikel):
 @click.argument("task")
 @click.option("-d", "--due")
 def get_newest_submissions(task, due):
-    cur = get_db().cursor()
     if due:
         dt = time.strptime(due,"%Y-%m-%d-%H-%M")
-        dts = int(time.mktime(dt))
-        cur.execute("""
-        SELECT ts.task_id, MAX(ts.submission_time) as submission_time, ts.filepath, ts.original_name
-          FROM task_submissions ts
-          LEFT JOIN tasks t ON t.task_id = ts.task_id
-          WHERE t.task_short=? and ts.submission_time < ?
-          GROUP BY ts.task_id,ts.team_id
-        """, (task,dts))
-    else:
-        cur.execute("""
-        SELECT ts.task_id, MAX(ts.submission_time) as submission_time, ts.filepath, ts.original_name
-          FROM task_submissions ts
-          LEFT JOIN tasks t ON t.task_id = ts.task_id
-          WHERE t.task_short=?
-          GROUP BY ts.task_id,ts.team_id
-        """, (task,))
-    for r in cur.fetchall():
+        due = int(time.mktime(dt))
+    cur = taskadmin.query_submissions(get_db().cursor(), [task], latest=True, due=due)
+    for r in cur:
         print(r["filepath"])
 
 @cli.command()
@@ -11,7 +11,10 @@ import sys
 import shutil
 import re
 import zipfile
-import time
+import signal
+import threading
+import collections
+import queue
 
 MAX_LINES = 100
 SIZE_LIMIT_REPLY = 8 * 1024
@@ -25,29 +28,69 @@ HOST = os.environ.get("SCOREBOARD_URL", "https://scoreboard.sec.in.tum.de")
 APIKEY = os.environ.get("SCOREBOARD_APIKEY")
 IMAGE_NAME = os.environ.get("AUTOGRADER_IMAGE", "grader")
 INTERVAL = int(os.environ.get("AUTOGRADER_INTERVAL", 30))
+# Seconds the scoreboard holds a claim open while there is nothing to grade (capped at 25 by the
+# scoreboard); 0 falls back to asking every INTERVAL seconds
+LONG_POLL = int(os.environ.get("AUTOGRADER_LONG_POLL", 25))
 TIMEOUT = int(os.environ.get("AUTOGRADER_TIMEOUT", 150))
 CONTAINER_SERVICE = os.environ.get("AUTOGRADER_CONTAINER_SERVICE", "docker")
 INSTANCE_ID = os.environ.get("AUTOGRADER_INSTANCE_ID", IMAGE_NAME)
 SANDBOX_DIR_PREFIX = f"autogradingsandbox_{INSTANCE_ID}_"
-if CONTAINER_SERVICE == "docker":
-	import docker as container_service
-	from docker.types import Mount
-	using_podman = False
-elif CONTAINER_SERVICE == "podman":
-	import podman as container_service
-	class Mount(dict):
-		def __init__(self, target, source, type):
-			self['target'] = target
-			self['source'] = source
-			self['type'] = type
-	using_podman = True
-else:
-	raise Exception("AUTOGRADER_CONTAINER_SERVICE has to be one of \"docker\", \"podman\"")
-
-container_service_client = container_service.from_env()
+# Number of submissions graded concurrently, each in its own container
+SLOTS = int(os.environ.get("AUTOGRADER_SLOTS", 4))
+# Resource caps per grading container; an empty value disables the cap
+MEM_LIMIT = os.environ.get("AUTOGRADER_MEM_LIMIT", "1g")
+CPUS = os.environ.get("AUTOGRADER_CPUS", "1")
+PIDS_LIMIT = os.environ.get("AUTOGRADER_PIDS_LIMIT", "256")
+# Run submissions in pre-started containers that are reset between jobs instead of starting a new
+# container per submission (needs streaming exec, so docker only; ignored for podman). A container is replaced
+# after CONTAINER_REUSE jobs or as soon as a reset fails.
+# A reset only removes what the grading user owns, which can't be told apart from the image's files
+# if that user is root, so a grader running as root always uses one-off containers.
+WARM_POOL = os.environ.get("AUTOGRADER_WARM_POOL", "1") == "1" and CONTAINER_SERVICE == "docker" and os.getuid() != 0
+CONTAINER_REUSE = int(os.environ.get("AUTOGRADER_CONTAINER_REUSE", 25))
+# Seconds a slot waits for a warm container before it gives the submission back to the scoreboard
+CONTAINER_WAIT = int(os.environ.get("AUTOGRADER_CONTAINER_WAIT", 60))
+# Identifies this process' claims at the scoreboard; unique so a restarted grader doesn't renew stale leases
+LEASE_HOLDER = f"{INSTANCE_ID}-{os.getrandom(4).hex()}"
+
+# Set by load_container_service()
+container_service = None
+Mount = None
+using_podman = False
+
+def load_container_service():
+	global container_service, Mount, using_podman
+	if CONTAINER_SERVICE == "docker":
+		import docker as container_service
+		from docker.types import Mount
+		using_podman = False
+	elif CONTAINER_SERVICE == "podman":
+		import podman as container_service
+		class Mount(dict):
+			def __init__(self, target, source, type):
+				self['target'] = target
+				self['source'] = source
+				self['type'] = type
+		using_podman = True
+	else:
+		raise Exception("AUTOGRADER_CONTAINER_SERVICE has to be one of \"docker\", \"podman\"")
+
+def resource_limits():
+	"""Keyword arguments for containers.run(); cpu_period/cpu_quota are understood by docker and podman"""
+	limits = {}
+	if MEM_LIMIT:
+		limits["mem_limit"] = MEM_LIMIT
+	if CPUS:
+		limits["cpu_period"] = 100000
+		limits["cpu_quota"] = int(float(CPUS) * 100000)
+	if PIDS_LIMIT:
+		limits["pids_limit"] = int(PIDS_LIMIT)
+	return limits
 
 logging.getLogger().setLevel(logging.INFO)
-logging.getLogger().addHandler(logging.StreamHandler())
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter("%(threadName)s: %(message)s"))
+logging.getLogger().addHandler(handler)
 
 class StatusCodeException(Exception):
 	pass
@@ -61,45 +104,104 @@ def check_status(r):
 
 def main():
 	print(f"Using {HOST} as Scoreboard API")
-	print(f"Using {IMAGE_NAME} as image")
+	print(f"Using {IMAGE_NAME} as image, {SLOTS} grading slots")
 
+	load_container_service()
+	client = container_service.from_env()
 	# Cleanup in case previous runs got stuck / crashed
-	for c in container_service_client.containers.list(all=True, filters={"label": f"autograding-{INSTANCE_ID}-autokill"}):
+	for c in client.containers.list(all=True, filters={"label": f"autograding-{INSTANCE_ID}-autokill"}):
 		print(f"Cleaning up stale container {c.id} / {c.name} from previous run")
 		c.remove(force=True)
 	sandbox_root = tempfile.gettempdir()
 	for n in [n for n in os.listdir(sandbox_root) if n.startswith(SANDBOX_DIR_PREFIX)]:
 		print(f"Cleaning up stale sandbox directory {n}")
-		delete_sandbox_dir(os.path.join(sandbox_root, n))
+		delete_sandbox_dir(client, os.path.join(sandbox_root, n))
+
+	pool = GraderPool(SLOTS)
+	def on_signal(signum, frame):
+		if pool.stopping.is_set():
+			logging.info("Killing running gradings, their submissions stay in the queue")
+			pool.stop(abort=True)
+		else:
+			logging.info("Shutting down after the running gradings; signal again to abort them")
+			pool.stop()
+	signal.signal(signal.SIGINT, on_signal)
+	signal.signal(signal.SIGTERM, on_signal)
 
-	while True:
+	pool.start()
+	while not pool.stopping.is_set():
+		if pool.sandboxes and pool.sandboxes.broken.is_set():
+			# Don't claim submissions that would only wait for a container and be released again
+			pool.stopping.wait(INTERVAL)
+			continue
+		# Keep up to one submission per slot claimed in addition to the running ones
+		room = 2 * SLOTS - pool.queue.size()
+		if room < SLOTS:
+			pool.queue.wait_for_room(SLOTS + 1, INTERVAL, pool.stopping)
+			continue
 		try:
-			autograding_iter()
-		except StatusCodeException:
-			pass
-		time.sleep(INTERVAL)
+			# Returns as soon as there is work, or after LONG_POLL seconds
+			claimed, pool.lease_seconds = claim_submissions(room, LONG_POLL)
+			pool.queue.add(claimed)
+		except (StatusCodeException, requests.exceptions.RequestException) as e:
+			logging.error(f"Could not claim submissions: {e!r}")
+			pool.stopping.wait(INTERVAL)
+			continue
+		if not claimed and not LONG_POLL:
+			pool.stopping.wait(INTERVAL)
+	pool.join()
+
+def claim_submissions(limit, wait=0):
+	if limit < 1:
+		return [], None
+	logging.info(f"Claiming up to {limit} submissions from the scoreboard")
+	r = check_status(requests.post(f"{HOST}/autograde/claim?APIKEY={APIKEY}", data={"holder": LEASE_HOLDER, "limit": limit, "wait": wait},
+		timeout=wait + 30))
+	claimed = r.json()
+	logging.info(f"Got {len(claimed['submissions'])} submissions from scoreboard")
+	return claimed["submissions"], claimed["lease_seconds"]
+
+def renew_leases(ids):
+	"""Returns the ids we still hold"""
+	r = check_status(requests.post(f"{HOST}/autograde/heartbeat?APIKEY={APIKEY}", data={"holder": LEASE_HOLDER, "id": ids}))
+	return r.json()["held"]
+
+def release_leases(ids):
+	check_status(requests.post(f"{HOST}/autograde/release?APIKEY={APIKEY}", data={"holder": LEASE_HOLDER, "id": ids}))
+
+def fetch_submission(id):
+	return check_status(requests.get(f"{HOST}/autograde/{id}?APIKEY={APIKEY}")).content
+
+def reset_challenge(url):
+	r = requests.post(url)
+	logging.info(f"Resetting challenge resulted in status {r.status_code}")
 
 def upload_answer(id, output, force_fail, time_start):
-	print("Sending response...")
+	logging.info(f"Sending response for submission {id}...")
 	# flag = flag_regex.search(output)
 	answer = {
 		"output": output,
 		"force_fail": force_fail,
-		"start_time": time_start
+		"start_time": time_start,
+		"holder": LEASE_HOLDER
 	}
 	# print(output)
-	r = check_status(requests.post(f"{HOST}/autograde/{id}?APIKEY={APIKEY}", data=answer))
-	print(f"Grading upload response: {r.text}")
+	r = requests.post(f"{HOST}/autograde/{id}?APIKEY={APIKEY}", data=answer)
+	if r.status_code == 409:
+		logging.info(f"Lease on submission {id} expired and it was claimed by another grader, discarding result")
+		return
+	check_status(r)
+	logging.info(f"Grading upload response: {r.text}")
 
-def delete_sandbox_dir(sandbox_dir):
+def delete_sandbox_dir(client, sandbox_dir):
 	try:
 		shutil.rmtree(sandbox_dir)
 	except PermissionError:
 		# This happens if container creates subdirectories not owned by container's root.
 		mnts = [Mount("/mnt", sandbox_dir, type="bind")]
 		# TODO We're assuming that that image contains rm.
-		container_service_client.containers.run(IMAGE_NAME, ["rm", "-rf", "--"] + [f"/mnt/{n}" for n in os.listdir(sandbox_dir)],
-			name=f"autograding-{IMAGE_NAME}-cleanup",
+		client.containers.run(IMAGE_NAME, ["rm", "-rf", "--"] + [f"/mnt/{n}" for n in os.listdir(sandbox_dir)],
+			name=f"autograding-{IMAGE_NAME}-cleanup-{os.getrandom(8).hex()}",
 			mounts=mnts,
 			labels={f"autograding-{IMAGE_NAME}-autokill": "1"},
 			user="0:0",
@@ -107,51 +209,228 @@ def delete_sandbox_dir(sandbox_dir):
 			remove=True)
 		os.rmdir(sandbox_dir)
 
-def autograding_iter():
-	logging.info("Asking the scoreboard for more submissions to check")
-	r = check_status(requests.get(f"{HOST}/autograde?APIKEY={APIKEY}"))
+class SubmissionQueue:
+	"""Submissions claimed from the scoreboard, waiting for a grading slot or being graded.
+	next() hands out the submission whose team occupies the fewest slots and got the fewest gradings
+	since the queue was last empty, then whose task occupies the fewest slots, oldest first: one team
+	uploading many solutions or one task with slow exploits can't take all slots."""
+	def __init__(self):
+		self.cond = threading.Condition()
+		self.waiting = {}
+		self.running = {}
+		self.served = collections.Counter()
+
+	def add(self, submissions):
+		with self.cond:
+			self.waiting.update((s["id"], s) for s in submissions if s["id"] not in self.running)
+			self.cond.notify_all()
+
+	def size(self):
+		with self.cond:
+			return len(self.waiting) + len(self.running)
+
+	def ids(self):
+		with self.cond:
+			return list(self.waiting) + list(self.running)
+
+	def drop_waiting(self, ids):
+		"""Forgets waiting submissions, e.g. because their lease was lost; returns those that were waiting"""
+		with self.cond:
+			return [self.waiting.pop(i) for i in ids if i in self.waiting]
 
-	submissions = r.json()
+	def wait_for_room(self, limit, timeout, stopping):
+		"""Waits until fewer than limit submissions are waiting or running"""
+		with self.cond:
+			return self.cond.wait_for(lambda: stopping.is_set() or len(self.waiting) + len(self.running) < limit, timeout)
 
-	# server_data = {"flag_regex": "flag{[^}]*}", "submissions": [{"id": 1}]}
-	logging.info(f"Got {len(submissions)} new submissions from scoreboard")
+	def next(self, stopping):
+		"""Blocks until a submission is available; returns None once stopping is set"""
+		with self.cond:
+			while not self.waiting or stopping.is_set():
+				if stopping.is_set():
+					return None
+				self.cond.wait(1)
+			teams = collections.Counter(s.get("team_id") for s in self.running.values())
+			tasks = collections.Counter(s.get("task_short") for s in self.running.values())
+			s = min(self.waiting.values(), key=lambda s: (teams[s.get("team_id")], self.served[s.get("team_id")], tasks[s.get("task_short")], s["id"]))
+			del self.waiting[s["id"]]
+			self.running[s["id"]] = s
+			self.served[s.get("team_id")] += 1
+			return s
 
-	# flag_regex = re.compile(server_data["flag_regex"].encode()) # We need a bytes regex
+	def done(self, s):
+		with self.cond:
+			del self.running[s["id"]]
+			if not self.waiting and not self.running:
+				self.served.clear()
+			self.cond.notify_all()
 
-	for s in submissions:
+	def wait_idle(self, timeout=None):
+		with self.cond:
+			return self.cond.wait_for(lambda: not self.waiting and not self.running, timeout)
+
+class GraderPool:
+	"""SLOTS worker threads, each grading one submission at a time with its own container client
+	(or in a container from the SandboxPool), and a heartbeat thread renewing the leases on all
+	claimed submissions.
+	stop() lets the running gradings finish; stop(abort=True) kills their containers and skips
+	uploading the (incomplete) results. Either way, join() releases the leases of all submissions
+	that weren't graded, so other graders can pick them up immediately. Containers and sandbox
+	directories are removed in both cases."""
+	def __init__(self, slots):
+		self.queue = SubmissionQueue()
+		self.stopping = threading.Event()
+		self.aborting = threading.Event()
+		self.closed = threading.Event()
+		self.lock = threading.Lock()
+		self.containers = {}
+		self.unfinished = []
+		self.lease_seconds = None
+		self.threads = [threading.Thread(target=self.run_slot, name=f"slot-{i}") for i in range(slots)]
+		self.heartbeat = threading.Thread(target=self.keep_leases, name="heartbeat")
+		self.sandboxes = SandboxPool(slots) if WARM_POOL else None
+
+	def start(self):
+		for t in self.threads:
+			t.start()
+		self.heartbeat.start()
+
+	def stop(self, abort=False):
+		self.stopping.set()
+		with self.queue.cond:
+			self.queue.cond.notify_all()
+		if self.sandboxes:
+			self.sandboxes.wake()
+		if abort:
+			self.aborting.set()
+			with self.lock:
+				containers = list(self.containers.values())
+			for c in containers:
+				try:
+					c.kill()
+				except Exception as e:
+					logging.warning(f"Could not kill container {c.id}: {e!r}")
+
+	def join(self):
+		for t in self.threads:
+			t.join()
+		unfinished = [s["id"] for s in self.queue.drop_waiting(self.queue.ids())] + self.unfinished
+		if unfinished:
+			logging.info(f"Releasing {len(unfinished)} claimed submissions")
+			try:
+				release_leases(unfinished)
+			except (StatusCodeException, requests.exceptions.RequestException) as e:
+				logging.error(f"Could not release leases, they will expire: {e!r}")
+		self.closed.set()
+		self.heartbeat.join()
+		if self.sandboxes:
+			self.sandboxes.close()
+
+	def keep_leases(self):
+		# Keeps running while gradings finish after stop()
+		while not self.closed.wait((self.lease_seconds or 60) / 3):
+			ids = self.queue.ids()
+			if not ids:
+				continue
+			try:
+				held = set(renew_leases(ids))
+			except (StatusCodeException, requests.exceptions.RequestException) as e:
+				logging.error(f"Could not renew leases: {e!r}")
+				continue
+			for s in self.queue.drop_waiting([i for i in ids if i not in held]):
+				logging.info(f"Lost lease on submission {s['id']}, not grading it")
+
+	def run_slot(self):
+		client = container_service.from_env()
+		while (s := self.queue.next(self.stopping)) is not None:
+			try:
+				if self.sandboxes:
+					self.grade_warm(s)
+				else:
+					self.grade(client, s)
+			except Exception:
+				# The submission stays in the scoreboard's queue and is retried after the next poll
+				logging.exception(f"Grading submission {s['id']} failed")
+			finally:
+				self.queue.done(s)
+
+	def prepare_submission(self, s):
+		"""Resets the challenge and downloads the submission. Returns (filename, content, time_start),
+		or None if the submission can't be autograded, in which case a placeholder result was uploaded."""
 		logging.info(f"Testing submission ID {s['id']} filename {s['filename']}")
 		reset_url = s.get("reset_url", "")
 		if reset_url:
-			r = requests.post(s["reset_url"])
-			logging.info(f"Resetting challenge resulted in status {r.status_code}")
+			reset_challenge(reset_url)
 		time_start = time.time()
-		r = check_status(requests.get(f"{HOST}/autograde/{s['id']}?APIKEY={APIKEY}"))
+		content = fetch_submission(s['id'])
 
 		filename = os.path.basename(s['filename'])
 		if not filename.endswith(".py") and not filename.endswith(".zip"):
 			logging.info(f"Skipping submission {s['id']}: {filename} - extension not supported; uploading placeholder response")
 			upload_answer(s['id'], "Submission not autogradable (extension not supported)", True, time_start)
-			continue
+			return None
 
-		# tempfile.mkdtemp says: "The directory is [accessible] only by the creating user."
-		sandbox_dir = tempfile.mkdtemp(prefix=SANDBOX_DIR_PREFIX)
+		filename = filename.replace("\x00", "")
+		filename = filename.replace("/", "").replace("\\", "") # Should not be necessary, but better safe than sorry
+		return filename, content, time_start
+
+	def grade_warm(self, s):
+		sandbox = self.sandboxes.get(self.stopping, CONTAINER_WAIT)
+		if sandbox is None:
+			if self.stopping.is_set():
+				self.unfinished.append(s['id'])
+				return
+			# Holding on to it would keep renewing the lease, so no other grader could take it
+			logging.error(f"No container available for submission {s['id']} after {CONTAINER_WAIT}s, releasing it")
+			release_leases([s['id']])
+			return
 		try:
-			# Podman bind mounts apparently don't work for 0700 folders directly
-			mounted_dir = os.path.join(sandbox_dir, "accessible")
-			os.mkdir(mounted_dir)
-			# Is inside sandbox_dir, which is only accessible for current user, so this is fine.
-			# And otherwise podman mount can't write.
-			os.chmod(mounted_dir, 0o0777)
+			prepared = self.prepare_submission(s)
+		except:
+			self.sandboxes.put(sandbox)
+			raise
+		if prepared is None:
+			self.sandboxes.put(sandbox)
+			return
+		filename, content, time_start = prepared
 
-			filename = filename.replace("\x00", "")
-			filename = filename.replace("/", "").replace("\\", "") # Should not be necessary, but better safe than sorry
+		with self.lock:
+			self.containers[s['id']] = sandbox.container
+		try:
+			with open(os.path.join(sandbox.mounted_dir, filename), "wb") as f:
+				f.write(content)
+			logging.info("Running submission in warm container")
+			buf, total_len, killed_by_timeout = sandbox.run(filename)
+			logging.info(f"Run complete; killed_by_timeout={killed_by_timeout}")
+		finally:
+			with self.lock:
+				self.containers.pop(s['id'], None)
+			# Reset (or replace) the container in the background, it isn't needed for the upload
+			self.sandboxes.put(sandbox)
+
+		if self.aborting.is_set():
+			logging.info(f"Not uploading result of aborted submission {s['id']}")
+			self.unfinished.append(s['id'])
+			return
+		upload_answer(s['id'], format_output(buf, total_len, killed_by_timeout), killed_by_timeout, time_start)
+		logging.info(f"done with submission {s['id']}!")
+
+	def grade(self, client, s):
+		prepared = self.prepare_submission(s)
+		if prepared is None:
+			return
+		filename, content, time_start = prepared
 
+		# tempfile.mkdtemp says: "The directory is [accessible] only by the creating user."
+		sandbox_dir = tempfile.mkdtemp(prefix=SANDBOX_DIR_PREFIX)
+		try:
+			mounted_dir = make_mounted_dir(sandbox_dir)
 			with open(os.path.join(mounted_dir, filename), "wb") as f:
-				f.write(r.content)
+				f.write(content)
 
 			mnts = []
 			mnts.append(Mount("/mnt", mounted_dir, type="bind"))
-			c = container_service_client.containers.run(IMAGE_NAME, ['/run.sh', filename],
+			c = client.containers.run(IMAGE_NAME, ['/run.sh', filename],
 				name=f"autograding-{IMAGE_NAME}-{s['id']}-{os.getrandom(16).hex()}",
 				labels={f"autograding-{IMAGE_NAME}-autokill": "1"},
 				user=f"{os.getuid()}:{os.getgid()}",
@@ -159,9 +438,12 @@ def autograding_iter():
 				mounts=mnts,
 				network_mode="host",
 				detach=True,
-				init=True)
+				init=True,
+				**resource_limits())
+			with self.lock:
+				self.containers[s['id']] = c
 			try:
-				print("waiting for container")
+				logging.info("waiting for container")
 				if using_podman:
 					# podman's wait doesn't have timeout capability.
 					# So, manual polling it is.
@@ -181,7 +463,11 @@ def autograding_iter():
 						killed_by_timeout = False
 					except requests.exceptions.ConnectionError:
 						killed_by_timeout = True
-				print(f"Wait complete; killed_by_timeout={killed_by_timeout}")
+				logging.info(f"Wait complete; killed_by_timeout={killed_by_timeout}")
+				if self.aborting.is_set():
+					logging.info(f"Not uploading result of aborted submission {s['id']}")
+					self.unfinished.append(s['id'])
+					return
 				if killed_by_timeout:
 					logging.info(f"Stopping container")
 					# Timeout of 1 to allow flushing logs. This call will kill the container after timeout elapsed.
@@ -191,48 +477,215 @@ def autograding_iter():
 					else:
 						c.stop(timeout=1)
 
-				# read logs
-				print("Reading logs...")
-				total_len = 0
-				total_chunks = 0
-				buf = b""
+				logging.info("Reading logs...")
 				# For SOME REASON, using stream=True with follow=True with a stopped container on Podman doesn't show the entire output.
 				# No idea why, but setting follow to False should be fine since the container is stopped now anyway.
-				for chunk in c.logs(stream=True, follow=False):
-					total_chunks += 1
-					total_len += len(chunk)
-					if total_chunks > MAX_CHUNKS or total_len > SIZE_LIMIT_TOTAL:
-						buf += b"\n\n[Output way too long! Giving up trying to seek to the end; arbitrary middle part of output will be shown.]"
-						print(f"Giving up reading logs; too long: total_len {total_len}, total_chunks {total_chunks}")
-						break
-					buf += chunk
-					# avoid storing / concatenating log content beyond what we'll ever need
-					if len(buf) > SIZE_LIMIT_REPLY:
-						buf = buf[-SIZE_LIMIT_REPLY:]
-
-				# truncate log
-				print("Truncating logs and assembling final output...")
-				if len(buf) > SIZE_LIMIT_REPLY:
-					buf = buf[-SIZE_LIMIT_REPLY:]
-				buf = b"".join(buf.splitlines(keepends=True)[-MAX_LINES:])
-
-				# assemble final output string
-				output = buf.decode(errors="replace")
-				# this handles both MAX_LINES as well as SIZE_LIMIT_REPLY
-				if len(buf) != total_len:
-					output = "[Log truncated]\n\n[...]" + output
-				if killed_by_timeout:
-					output = f"[Execution took more than {TIMEOUT} seconds, aborting - flags will not count]\n\n" + output
+				buf, total_len = read_output(c.logs(stream=True, follow=False))
+				output = format_output(buf, total_len, killed_by_timeout)
 			finally:
-				print("Removing container...")
+				logging.info("Removing container...")
+				with self.lock:
+					self.containers.pop(s['id'], None)
 				# force=True should not be necessary, but better safe than sorry
 				c.remove(force=True)
 
 			upload_answer(s['id'], output, killed_by_timeout, time_start)
 		finally:
-			print("Cleaning up tmpdir...")
-			delete_sandbox_dir(sandbox_dir)
-		print(f"done with submission {s['id']}!")
+			logging.info("Cleaning up tmpdir...")
+			delete_sandbox_dir(client, sandbox_dir)
+		logging.info(f"done with submission {s['id']}!")
+
+def make_mounted_dir(sandbox_dir):
+	# Podman bind mounts apparently don't work for 0700 folders directly
+	mounted_dir = os.path.join(sandbox_dir, "accessible")
+	os.mkdir(mounted_dir)
+	# Is inside sandbox_dir, which is only accessible for current user, so this is fine.
+	# And otherwise podman mount can't write.
+	os.chmod(mounted_dir, 0o0777)
+	return mounted_dir
+
+def read_output(chunks):
+	"""Reads container output, keeping only the last SIZE_LIMIT_REPLY bytes. Returns (buf, total_len)."""
+	total_len = 0
+	total_chunks = 0
+	buf = b""
+	for chunk in chunks:
+		total_chunks += 1
+		total_len += len(chunk)
+		if total_chunks > MAX_CHUNKS or total_len > SIZE_LIMIT_TOTAL:
+			buf += b"\n\n[Output way too long! Giving up trying to seek to the end; arbitrary middle part of output will be shown.]"
+			logging.info(f"Giving up reading logs; too long: total_len {total_len}, total_chunks {total_chunks}")
+			break
+		buf += chunk
+		# avoid storing / concatenating log content beyond what we'll ever need
+		if len(buf) > SIZE_LIMIT_REPLY:
+			buf = buf[-SIZE_LIMIT_REPLY:]
+	return buf, total_len
+
+def format_output(buf, total_len, killed_by_timeout):
+	# truncate log
+	if len(buf) > SIZE_LIMIT_REPLY:
+		buf = buf[-SIZE_LIMIT_REPLY:]
+	buf = b"".join(buf.splitlines(keepends=True)[-MAX_LINES:])
+
+	# assemble final output string
+	output = buf.decode(errors="replace")
+	# this handles both MAX_LINES as well as SIZE_LIMIT_REPLY
+	if len(buf) != total_len:
+		output = "[Log truncated]\n\n[...]" + output
+	if killed_by_timeout:
+		output = f"[Execution took more than {TIMEOUT} seconds, aborting - flags will not count]\n\n" + output
+	return output
+
+JOB_USER = f"{os.getuid()}:{os.getgid()}"
+# Mount points of their own filesystems that a submission can write to. Everything owned by JOB_USER
+# on these and on the image's root filesystem is deleted between two jobs.
+RESET_PATHS = ["/mnt", "/tmp", "/var/tmp", "/dev/shm"]
+
+class Sandbox:
+	"""A container idling in `sleep infinity` (as root) with its own sandbox directory mounted at /mnt.
+	Submissions are run in it with exec as JOB_USER; reset() kills whatever they left running and
+	deletes all files JOB_USER owns as root, so unlike for one-off containers no cleanup container
+	is needed. Changes a submission makes to files it doesn't own (only possible for world-writable
+	files of the image) are not undone."""
+	def __init__(self, client):
+		self.client = client
+		self.dir = tempfile.mkdtemp(prefix=SANDBOX_DIR_PREFIX)
+		self.mounted_dir = make_mounted_dir(self.dir)
+		self.uses = 0
+		# The RESET_PATHS that exist in the image, looked up on the first reset
+		self.reset_paths = None
+		self.container = client.containers.run(IMAGE_NAME, ["sleep", "infinity"],
+			name=f"autograding-{IMAGE_NAME}-warm-{os.getrandom(16).hex()}",
+			labels={f"autograding-{IMAGE_NAME}-autokill": "1"},
+			user="0:0",
+			working_dir="/mnt",
+			mounts=[Mount("/mnt", self.mounted_dir, type="bind")],
+			network_mode="host",
+			detach=True,
+			init=True,
+			**resource_limits())
+
+	def kill_job(self):
+		# kill -1 signals every process the user may signal except the shell itself; `sleep infinity` runs as root
+		self.container.exec_run(["sh", "-c", "kill -9 -1"], user=JOB_USER)
+
+	def run(self, filename):
+		"""Runs the submission and returns (output, total output length, killed_by_timeout)"""
+		self.uses += 1
+		timed_out = threading.Event()
+		def on_timeout():
+			timed_out.set()
+			self.kill_job()
+		timer = threading.Timer(TIMEOUT, on_timeout)
+		timer.start()
+		try:
+			# Background processes of the submission may keep the output open; killing them on timeout ends it
+			result = self.container.exec_run(["/run.sh", filename], user=JOB_USER, workdir="/mnt", stream=True)
+			buf, total_len = read_output(result.output)
+		finally:
+			timer.cancel()
+		return buf, total_len, timed_out.is_set()
+
+	def reset(self):
+		"""Returns whether the container is clean and can run the next submission"""
+		try:
+			self.kill_job()
+			if self.reset_paths is None:
+				# find fails for missing start points, and minimal images may lack e.g. /var/tmp
+				_, output = self.container.exec_run(["sh", "-c", 'for p; do [ -d "$p" ] && echo "$p"; done', "sh"] + RESET_PATHS, user="0:0")
+				self.reset_paths = [p for p in output.decode().split() if p in RESET_PATHS]
+			# -xdev keeps find out of /proc and /sys; the scratch filesystems are searched on their own.
+			# The mount points themselves stay, /mnt is owned by JOB_USER.
+			keep = [arg for path in self.reset_paths for arg in ["!", "-path", path]]
+			exit_code, output = self.container.exec_run(["find", "/"] + self.reset_paths + ["-xdev", "-mindepth", "1", "-user", str(os.getuid())] + keep + ["-delete"], user="0:0")
+			if exit_code != 0:
+				logging.warning(f"Resetting container {self.container.id} failed, replacing it: find exited with {exit_code}: {output[-1000:].decode(errors='replace')}")
+				return False
+			return True
+		except Exception as e:
+			logging.warning(f"Resetting container {self.container.id} failed: {e!r}")
+			return False
+
+	def destroy(self):
+		try:
+			self.container.remove(force=True)
+		except Exception as e:
+			logging.warning(f"Removing container {self.container.id} failed: {e!r}")
+		delete_sandbox_dir(self.client, self.dir)
+
+class SandboxPool:
+	"""Keeps a warm Sandbox per slot plus a spare, so a slot doesn't have to wait for the reset of
+	the container it just used. Used sandboxes are reset, or replaced once they ran CONTAINER_REUSE
+	submissions or failed to reset, by background threads; these also start the initial containers.
+	broken is set while containers fail to start."""
+	STOP = object()
+
+	def __init__(self, slots):
+		self.client = container_service.from_env()
+		self.size = slots + 1
+		# Sandboxes ready to use; STOP once the slots should stop waiting for them
+		self.idle = queue.Queue()
+		# Sandboxes to reset, or None to start a new one
+		self.recycling = queue.Queue()
+		self.closed = threading.Event()
+		self.broken = threading.Event()
+		for _ in range(self.size):
+			self.recycling.put(None)
+		self.recyclers = [threading.Thread(target=self.recycle, name=f"recycler-{i}", daemon=True) for i in range(self.size)]
+		for t in self.recyclers:
+			t.start()
+
+	def get(self, stopping, timeout):
+		"""Returns a sandbox, or None if there was none within timeout seconds or stopping is set"""
+		deadline = time.monotonic() + timeout
+		while not stopping.is_set() and (remaining := deadline - time.monotonic()) > 0:
+			try:
+				sandbox = self.idle.get(timeout=min(remaining, 1))
+			except queue.Empty:
+				continue
+			if sandbox is self.STOP:
+				# Leave it for the other waiting slots
+				self.idle.put(self.STOP)
+				return None
+			return sandbox
+		return None
+
+	def wake(self):
+		"""Makes waiting and future get() calls return None right away"""
+		self.idle.put(self.STOP)
+
+	def put(self, sandbox):
+		self.recycling.put(sandbox)
+
+	def recycle(self):
+		while (sandbox := self.recycling.get()) is not self.STOP:
+			if sandbox is not None:
+				if not self.closed.is_set() and sandbox.uses < CONTAINER_REUSE and sandbox.reset():
+					self.idle.put(sandbox)
+					continue
+				sandbox.destroy()
+			# Slots wait for this replacement, so keep trying
+			while not self.closed.is_set():
+				try:
+					self.idle.put(Sandbox(self.client))
+					self.broken.clear()
+					break
+				except Exception:
+					logging.exception("Starting a container failed")
+					self.broken.set()
+					self.closed.wait(INTERVAL)
+
+	def close(self):
+		"""Removes all containers; call once no slot uses the pool anymore"""
+		self.closed.set()
+		for _ in self.recyclers:
+			self.recycling.put(self.STOP)
+		for t in self.recyclers:
+			t.join()
+		while not self.idle.empty():
+			if (sandbox := self.idle.get()) is not self.STOP:
+				sandbox.destroy()
 
 if __name__ == '__main__':
 	main()
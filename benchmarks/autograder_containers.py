@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Per-submission overhead of the autograder with one-off containers vs. the warm container pool.
+
+Uses a fake container backend in which starting and removing a container and exec'ing into one
+take roughly as long as with docker on a typical grading machine (see LATENCY, adjustable), and
+every submission runs for JOB_TIME. The overhead is the time per submission beyond JOB_TIME.
+
+Needs the autograder's requirements (autograder/requirements.txt), not docker itself.
+Usage (from the repository root): python3 benchmarks/autograder_containers.py [submissions] [slots]
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autograder"))
+import grading
+
+# Seconds per container operation
+LATENCY = {"run": 0.4, "remove": 0.1, "exec": 0.02, "stop": 0.05}
+JOB_TIME = 0.05
+OUTPUT = [b"[+] Opening connection\n", b"flag{fake}\n"]
+
+ExecResult = collections.namedtuple("ExecResult", ["exit_code", "output"])
+
+class FakeContainer:
+    def __init__(self, backend, command):
+        self.backend = backend
+        self.id = os.urandom(8).hex()
+        self.command = command
+        self.killed = threading.Event()
+
+    def _job(self):
+        # Like /run.sh: runs for JOB_TIME unless killed, then the output is complete
+        self.killed.wait(JOB_TIME)
+        yield from OUTPUT
+
+    def wait(self, timeout):
+        self.killed.wait(JOB_TIME)
+        return {"StatusCode": 0}
+
+    def logs(self, stream, follow):
+        return iter(OUTPUT)
+
+    def exec_run(self, cmd, user=None, workdir=None, stream=False):
+        self.backend.call("exec")
+        if cmd[0] == "/run.sh":
+            self.killed = threading.Event()
+            return ExecResult(None, self._job()) if stream else ExecResult(0, b"".join(self._job()))
+        if cmd[:2] == ["sh", "-c"] and "kill" in cmd[2]:
+            self.killed.set()
+        return ExecResult(0, iter([]) if stream else b"")
+
+    def stop(self, timeout=None, **kwargs):
+        self.backend.call("stop")
+        self.killed.set()
+
+    def kill(self):
+        self.killed.set()
+
+    def remove(self, force=False):
+        self.backend.call("remove")
+
+class FakeContainers:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def run(self, image, command, **kwargs):
+        self.backend.call("run")
+        return FakeContainer(self.backend, command)
+
+    def list(self, **kwargs):
+        return []
+
+class FakeBackend:
+    """Stands in for the docker module and counts the container operations"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+
+    def call(self, op):
+        with self.lock:
+            self.calls[op] += 1
+        time.sleep(LATENCY[op])
+
+    def from_env(self):
+        client = type("FakeClient", (), {})()
+        client.containers = FakeContainers(self)
+        return client
+
+def run(warm, count, slots):
+    backend = FakeBackend()
+    grading.container_service = backend
+    grading.Mount = lambda target, source, type: {"target": target, "source": source}
+    grading.WARM_POOL = warm
+    grading.fetch_submission = lambda id: b"print('flag{fake}')"
+    grading.upload_answer = lambda id, output, force_fail, time_start: None
+    grading.renew_leases = lambda ids: ids
+    grading.release_leases = lambda ids: None
+
+    start = time.perf_counter()
+    pool = grading.GraderPool(slots)
+    if warm:
+        # Wait until the containers are started
+        while pool.sandboxes.idle.qsize() < pool.sandboxes.size:
+            time.sleep(0.01)
+    startup = time.perf_counter() - start
+    backend.calls.clear()
+    start = time.perf_counter()
+    pool.start()
+    pool.queue.add({"id": i, "filename": "exploit.py", "reset_url": "", "task_short": "1", "team_id": i} for i in range(1, count + 1))
+    pool.queue.wait_idle()
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    pool.join()
+    return startup, elapsed, dict(backend.calls)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    slots = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    grading.logging.getLogger().setLevel(grading.logging.WARNING)
+    print(f"{count} submissions of {JOB_TIME * 1e3:.0f}ms each, {slots} slots, container latencies {LATENCY}")
+    print(f"{'mode':>8} {'startup':>9} {'total':>8} {'per sub':>9} {'overhead':>9}  container operations")
+    for warm in [False, True]:
+        startup, elapsed, calls = run(warm, count, slots)
+        per_submission = elapsed * slots / count
+        print(f"{'warm' if warm else 'one-off':>8} {startup:8.2f}s {elapsed:7.2f}s {per_submission * 1e3:7.0f}ms {(per_submission - JOB_TIME) * 1e3:7.0f}ms  "
+            + ", ".join(f"{op} {n}" for op, n in sorted(calls.items())))
+
+if __name__ == "__main__":
+    main()
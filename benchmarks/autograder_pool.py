@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Autograder throughput with 1, 2, 4, ... grading slots against a stub container backend.
+
+The stub containers sleep instead of running an exploit (most finish quickly, a few run into
+the timeout), and the scoreboard API is replaced by in-memory functions, so this measures the
+scheduling in autograder/grading.py only. Throughput should grow about linearly with the number
+of slots. Also reports how many slots the team with the most submissions held at once.
+
+Needs the autograder's requirements (autograder/requirements.txt), not docker itself.
+Usage (from the repository root): python3 benchmarks/autograder_pool.py [submissions] [max slots]
+"""
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "autograder"))
+import grading
+
+RUN_TIME = (0.02, 0.1)
+TIMEOUT = 0.5
+SLOW_FRACTION = 0.05
+
+class StubContainer:
+    def __init__(self, run_time):
+        self.id = os.urandom(8).hex()
+        self.run_time = run_time
+        self.killed = threading.Event()
+
+    def wait(self, timeout):
+        if self.killed.wait(min(self.run_time, timeout)) or self.run_time <= timeout:
+            return {"StatusCode": 0}
+        raise grading.requests.exceptions.ConnectionError()
+
+    def stop(self, timeout):
+        self.killed.set()
+
+    def kill(self):
+        self.killed.set()
+
+    def logs(self, stream, follow):
+        yield b"[+] Opening connection\n"
+        yield b"flag{stub}\n"
+
+    def remove(self, force):
+        pass
+
+class StubContainers:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def run(self, image, command, **kwargs):
+        return self.backend.start(command[1])
+
+    def list(self, **kwargs):
+        return []
+
+class StubBackend:
+    """Stands in for the docker module: from_env() returns a client per slot"""
+    def __init__(self, run_times):
+        self.run_times = run_times
+
+    def from_env(self):
+        client = type("StubClient", (), {})()
+        client.containers = StubContainers(self)
+        return client
+
+    def start(self, filename):
+        return StubContainer(self.run_times[filename])
+
+def make_submissions(count):
+    rng = random.Random(1)
+    submissions, run_times = [], {}
+    for i in range(count):
+        team = rng.randrange(1, 40)
+        filename = f"{team}-{i}.py"
+        submissions.append({"id": i + 1, "filename": filename, "reset_url": "", "task_short": str(i % 7), "team_id": team})
+        run_times[filename] = TIMEOUT * 2 if rng.random() < SLOW_FRACTION else rng.uniform(*RUN_TIME)
+    return submissions, run_times
+
+def run(slots, submissions, run_times):
+    backend = StubBackend(run_times)
+    uploaded = []
+    def upload_answer(id, output, force_fail, time_start):
+        uploaded.append(id)
+
+    grading.container_service = backend
+    # Containers are started per submission; see autograder_containers.py for the warm pool
+    grading.WARM_POOL = False
+    grading.Mount = lambda target, source, type: {"target": target, "source": source}
+    grading.TIMEOUT = TIMEOUT
+    grading.fetch_submission = lambda id: b"print('flag{stub}')"
+    grading.upload_answer = upload_answer
+    grading.renew_leases = lambda ids: ids
+    grading.release_leases = lambda ids: None
+
+    pool = grading.GraderPool(slots)
+    start = time.perf_counter()
+    pool.start()
+    pool.queue.add(submissions)
+    pool.queue.wait_idle()
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    pool.join()
+    assert sorted(uploaded) == [s["id"] for s in submissions]
+    return elapsed
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    max_slots = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    grading.logging.getLogger().setLevel(grading.logging.WARNING)
+    submissions, run_times = make_submissions(count)
+    print(f"{'slots':>6} {'time':>9} {'per second':>11} {'speedup':>8}")
+    slots = 1
+    baseline = None
+    while slots <= max_slots:
+        elapsed = run(slots, submissions, run_times)
+        baseline = baseline or elapsed
+        print(f"{slots:6} {elapsed:8.2f}s {count / elapsed:11.1f} {baseline / elapsed:7.1f}x")
+        slots *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Per-request database overhead with and without the connection pool.
+
+Simulates requests that each fetch a connection via get_db(), run a handful of typical
+queries and hand the connection back at teardown, against a scratch database file.
+
+Usage (from the repository root): python3 benchmarks/db_connection.py [requests]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+from board.util import get_db, init_db, add_user, create_team, release_db
+
+QUERIES = [
+    ("SELECT * FROM team_members tm LEFT JOIN teams t ON t.team_id = tm.team_id WHERE member_id = ? and t.deleted is null", (1,)),
+    ("SELECT task_id, task_short FROM tasks WHERE from_date < strftime('%s','now') ORDER BY order_num", ()),
+    ("SELECT version, snapshot_version, snapshot_id, valid_until FROM scoreboard_cache", ()),
+]
+
+def run(n, pool_size):
+    app.app.config["DB_POOL_SIZE"] = pool_size
+    start = time.perf_counter()
+    for _ in range(n):
+        with app.app.app_context():
+            cur = get_db().cursor()
+            for sql, params in QUERIES:
+                cur.execute(sql, params)
+                cur.fetchall()
+    return (time.perf_counter() - start) / n
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as d:
+        app.app.config["DATABASE"] = os.path.join(d, "bench.db")
+        # init_db reads the migrations relative to the working directory
+        os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        with app.app.app_context():
+            init_db()
+            add_user("bench", "bench", "bench", None, "bench")
+            create_team([1])
+            release_db()
+
+        # Warm up the OS page cache before measuring
+        run(100, 0)
+        per_request_new = run(n, 0)
+        per_request_pooled = run(n, 4)
+        print(f"{n} requests")
+        print(f"new connection per request: {per_request_new * 1e6:8.1f} us/request")
+        print(f"pooled connection:          {per_request_pooled * 1e6:8.1f} us/request")
+        print(f"speedup:                    {per_request_new / per_request_pooled:8.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Grade upload diffing (read_grade_csv + compare_grades) on synthetic grading files.
+
+Generates grading CSVs of increasing size together with a set of grades "already in the
+database" (half of them unchanged, a quarter modified, a quarter missing) and measures the time
+per row, which should stay flat as the file grows. For the smaller sizes the previous
+implementation, which scanned all database grades for every CSV row, is measured as well.
+
+Usage (from the repository root): python3 benchmarks/grade_diff.py [max rows]
+"""
+import csv
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from board.gradeupload import read_grade_csv, compare_grades
+
+TASKS = 40
+# The old implementation is quadratic; don't wait for it on the big files
+LEGACY_MAX_ROWS = 5000
+
+def legacy_compare_grades(db_grades, csv_grades):
+    r = []
+    for i in csv_grades:
+        for x in db_grades:
+            if i[0] == x["task_short"] and i[1] == x["team_id"]:
+                if not (i[2] == x["comment"] and i[3] == x["internal_comment"] and i[4] == x["points"] and i[5] == x["corrector"]):
+                    r.append(("m", i, None))
+                break
+        else:
+            r.append(("n", i, None))
+    return r
+
+def generate(path, rows):
+    teams = (rows + TASKS - 1) // TASKS
+    db_grades = []
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f, delimiter=";")
+        w.writerow(["team", "task", "points", "comment", "internal_comment", "corrector"])
+        for n in range(rows):
+            task, team = str(n % TASKS), n // TASKS + 1
+            w.writerow([team, task, "2,5", f"comment {n}", "", "bench"])
+            if n % 4 == 3:
+                continue
+            # Every other grade differs from the database
+            db_grades.append({"task_short": task, "team_id": team, "comment": f"comment {n}" if n % 2 == 0 else "old",
+                "internal_comment": "", "points": 2.5, "corrector": "bench"})
+    return set(range(1, teams + 1)), {str(t) for t in range(TASKS)}, db_grades
+
+def main():
+    max_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    sizes = [max_rows // 8, max_rows // 4, max_rows // 2, max_rows]
+    print(f"{'rows':>8} {'parse':>10} {'diff':>10} {'per row':>10} {'old diff':>10}")
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "grading.csv")
+        for rows in sizes:
+            teams, tasks, db_grades = generate(path, rows)
+            start = time.perf_counter()
+            csv_grades = read_grade_csv(path, teams, tasks)
+            parsed = time.perf_counter()
+            delta = compare_grades(db_grades, csv_grades)
+            done = time.perf_counter()
+            # Only the grades with an even row number are unchanged
+            assert len(delta) == rows - (rows + 1) // 2
+            legacy = ""
+            if rows <= LEGACY_MAX_ROWS:
+                start_legacy = time.perf_counter()
+                legacy_compare_grades(db_grades, csv_grades)
+                legacy = f"{(time.perf_counter() - start_legacy) * 1e3:8.1f}ms"
+            total = done - start
+            print(f"{rows:8} {(parsed - start) * 1e3:8.1f}ms {(done - parsed) * 1e3:8.1f}ms {total / rows * 1e6:8.2f}us {legacy:>10}")
+
+if __name__ == "__main__":
+    main()
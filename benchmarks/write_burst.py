@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""Write throughput under a burst of concurrent small writes, as seen near deadlines.
+
+Several processes (standing in for gunicorn workers) each issue many small writes of the
+kind every request produces (activity updates and log entries), once with one autocommit
+transaction per statement and once through the batching write queue.
+
+Usage (from the repository root): python3 benchmarks/write_burst.py [processes] [writes per process]
+"""
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import app
+from board.util import get_db, init_db, add_user, get_write_queue, queue_write
+
+def worker(mode, writes, errors):
+    failed = 0
+    with app.app.app_context():
+        for i in range(writes):
+            statements = [
+                ("UPDATE users SET last_active = strftime('%s','now') WHERE id = ?", (1 + i % 10,)),
+                ("INSERT INTO logs (time, user_id, category, message) VALUES (strftime('%s','now'),?,?,?)", (1, "bench", f"write {i}")),
+            ]
+            for sql, params in statements:
+                try:
+                    if mode == "direct":
+                        get_db().execute(sql, params)
+                    else:
+                        queue_write(sql, params)
+                except sqlite3.OperationalError:
+                    failed += 1
+        if mode == "queued":
+            get_write_queue().close()
+    with errors.get_lock():
+        errors.value += failed
+
+# SQLite's defaults, which the scoreboard used before (plus a busy timeout, otherwise most writes just fail)
+LEGACY_PRAGMAS = {"synchronous": "FULL", "busy_timeout": 5000}
+
+def run(mode, processes, writes, pragmas=None):
+    app.app.config["DB_WRITE_QUEUE"] = mode == "queued"
+    if pragmas:
+        app.app.config["DB_PRAGMAS"] = pragmas
+    else:
+        app.app.config.pop("DB_PRAGMAS", None)
+    errors = multiprocessing.Value("i", 0)
+    procs = [multiprocessing.Process(target=worker, args=(mode, writes, errors)) for _ in range(processes)]
+    start = time.perf_counter()
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - start
+    total = processes * writes * 2
+    label = mode + (" (rollback journal, synchronous=FULL)" if pragmas else " (WAL, synchronous=NORMAL)")
+    print(f"{label:45}: {total} writes in {elapsed:6.2f}s = {total / elapsed:8.0f} writes/s, {errors.value} failed")
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    writes = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    # Use a directory on disk: fsync cost is what makes per-statement commits expensive
+    with tempfile.TemporaryDirectory(dir=os.environ.get("BENCH_DIR", ".")) as d:
+        app.app.config["DATABASE"] = os.path.join(d, "bench.db")
+        # init_db reads the migrations relative to the working directory
+        os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+        with app.app.app_context():
+            init_db()
+            for i in range(10):
+                add_user(f"bench{i}", "bench", "bench", None, "bench")
+
+        # The journal mode is persistent, so switch it for the database as a whole
+        with app.app.app_context():
+            get_db().execute("PRAGMA journal_mode = DELETE")
+        run("direct", processes, writes, LEGACY_PRAGMAS)
+        with app.app.app_context():
+            get_db().execute("PRAGMA journal_mode = WAL")
+        run("direct", processes, writes)
+        run("queued", processes, writes)
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method("fork")
+    main()
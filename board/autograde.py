@@ -3,6 +3,7 @@ import flask.json
 import os
 import enum
 import math
+import collections
 
 from .util import *
 
@@ -15,61 +16,127 @@ class AutogradeStatus(enum.Enum):
     FLAG_NOT_FRESH = 4
     CANCELED = 5
 
-def get_submission_queue():
-    cur = get_db().cursor()
-    # TODO what if the autograder later does supply a result for any of these?
-    # It's probably more sane to introduce another key like is_queued
-    #cur.execute("""UPDATE task_submissions SET autograde_result = 5, autograde_output = '<overridden by later submission>'
-    #            WHERE id in (
-    #                SELECT s.id
-    #                FROM task_submissions s
-    #                LEFT JOIN tasks t USING (task_id)
-    #                LEFT JOIN task_submissions sb
-    #                ON sb.task_id = s.task_id and sb.team_id = s.team_id and sb.submission_time > s.submission_time
-    #                WHERE sb.submission_time is not null and t.autograded=1 and s.autograde_result IS NULL
-    #            )""")
+# Seconds a claimed submission stays reserved for its grader without a heartbeat
+DEFAULT_LEASE_SECONDS = 120
+# Longest time a claim waits for work (wait parameter), well below typical proxy/worker timeouts
+MAX_CLAIM_WAIT = 25
+# Waiting claims are woken directly by uploads handled in this process (by another thread, so this
+# needs a threaded gunicorn worker). Uploads to other worker processes and expired leases are
+# noticed by checking the newest submission id and the number of expired leases this often.
+CLAIM_POLL_INTERVAL = 1
+
+_new_submission = threading.Condition()
+
+def notify_new_submission():
+    with _new_submission:
+        _new_submission.notify_all()
 
+def get_submission_queue(unclaimed=False):
+    """Latest ungraded submission per team and autograded task, oldest first; see autograde_queue in db/34.sql.
+    unclaimed: leave out submissions that are leased to a grader"""
+    cur = get_db().cursor()
     cur.execute("""SELECT s.id as id, s.original_name as original_name, t.flag_key as flag_key, u.id as user_id, t.task_short as task_short, *,
                 CASE WHEN tt.teamname IS NULL THEN 'Team ' || tt.team_id ELSE tt.teamname END as team,
                 IIF(u.displayname IS NOT NULL, u.displayname, u.vorname || ' ' || u.nachname) as name
-                FROM task_submissions s
-                LEFT JOIN tasks t USING (task_id)
-                LEFT JOIN teams tt USING (team_id)
+                FROM autograde_queue q
+                JOIN task_submissions s ON s.id = q.submission_id
+                LEFT JOIN tasks t ON t.task_id = s.task_id
+                LEFT JOIN teams tt ON tt.team_id = s.team_id
                 LEFT JOIN users u ON u.id = s.user_id
-                LEFT JOIN task_submissions sb
-                ON sb.task_id = s.task_id and sb.team_id = s.team_id and sb.submission_time > s.submission_time
-                WHERE sb.submission_time is null and t.autograded=1 and s.autograde_result IS NULL""")
-
-    # ChatGPT's suggestion - doesn't seem faster:
-    #    cur.execute("""WITH ts_rownums AS (
-    #SELECT *,
-    #ROW_NUMBER() OVER (PARTITION BY task_id, team_id ORDER BY submission_time DESC) AS rownum
-    #FROM task_submissions
-    #LEFT JOIN tasks t USING (task_id)
-    #WHERE t.autograded = 1
-    #)
-    #SELECT s.id as id, s.original_name as original_name, *,
-    #CASE WHEN tt.teamname IS NULL THEN 'Team ' || tt.team_id ELSE tt.teamname END as team,
-    #                IIF(u.displayname IS NOT NULL, u.displayname, u.vorname || ' ' || u.nachname) as name
-    #                FROM ts_rownums s
-    #                LEFT JOIN teams tt USING (team_id)
-    #                LEFT JOIN users u ON u.id = s.user_id
-    #                WHERE s.autograde_result IS NULL AND s.rownum = 1""")
-
+                """ + ("WHERE s.id NOT IN (SELECT submission_id FROM autograde_leases WHERE expires > strftime('%s','now'))" if unclaimed else "") + """
+                ORDER BY q.submission_id""")
     return cur.fetchall()
 
+def submission_info(r):
+    reset_url = r['reset_url']
+    if reset_url:
+        verifier_code = compute_verifier(r, r['user_id'])
+        reset_url = reset_url.replace("{{CODE}}", verifier_code)
+    return {"id": r["id"], "filename": r["original_name"], "reset_url": reset_url, "task_short": r["task_short"], "team_id": r["team_id"]}
+
 @bp.route("/")
 def autograde_list():
     if not request.args.get("APIKEY", "") == current_app.config["AUTOGRADE_APIKEY"]:
         abort(403)
-    submission_data = []
-    for r in get_submission_queue():
-        reset_url = r['reset_url']
-        if reset_url:
-            verifier_code = compute_verifier(r, r['user_id'])
-            reset_url = reset_url.replace("{{CODE}}", verifier_code)
-        submission_data.append({"id": r['id'], "filename": r['original_name'], "reset_url": reset_url, "task_short": r["task_short"]})
-    return jsonify(submission_data)
+    return jsonify([submission_info(r) for r in get_submission_queue()])
+
+def claim_submissions(holder, limit):
+    """Leases up to limit unclaimed submissions to holder. Teams take turns: every team's oldest
+    submission comes before any team's second one."""
+    lease_seconds = current_app.config.get("AUTOGRADE_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)
+    with transaction() as cur:
+        cur.execute("DELETE FROM autograde_leases WHERE expires <= strftime('%s','now')")
+        queue = get_submission_queue(unclaimed=True)
+        turn = collections.Counter()
+        ranked = []
+        for r in queue:
+            turn[r["team_id"]] += 1
+            ranked.append((turn[r["team_id"]], r["id"], r))
+        claimed = [r for _, _, r in sorted(ranked, key=lambda x: x[:2])[:limit]]
+        cur.executemany("INSERT INTO autograde_leases (submission_id, holder, expires) VALUES (?, ?, strftime('%s','now') + ?)",
+            [(r["id"], holder, lease_seconds) for r in claimed])
+    return claimed, lease_seconds
+
+def claimable_state(cur):
+    """Changes whenever a new submission arrives or a lease has expired"""
+    cur.execute("""SELECT (SELECT MAX(id) FROM task_submissions),
+        (SELECT COUNT(*) FROM autograde_leases WHERE expires <= strftime('%s','now'))""")
+    return tuple(cur.fetchone())
+
+@bp.route("/claim", methods=["POST"])
+def autograde_claim():
+    """Hands out up to `limit` submissions to the grader instance `holder`. They are not handed out
+    again until the lease expires; the grader renews it with /heartbeat while it is working on them.
+    If there is nothing to grade, waits up to `wait` seconds (at most MAX_CLAIM_WAIT) for a submission."""
+    if not request.args.get("APIKEY", "") == current_app.config["AUTOGRADE_APIKEY"]:
+        abort(403)
+    holder = request.form.get("holder")
+    limit = request.form.get("limit", 1, type=int)
+    wait = min(request.form.get("wait", 0, type=float), MAX_CLAIM_WAIT)
+    if not holder or limit < 1:
+        abort(400)
+    deadline = time.monotonic() + wait
+    cur = get_db().cursor()
+    state = claimable_state(cur)
+    claimed, lease_seconds = claim_submissions(holder, limit)
+    while not claimed and (remaining := deadline - time.monotonic()) > 0:
+        with _new_submission:
+            notified = _new_submission.wait(min(remaining, CLAIM_POLL_INTERVAL))
+        new_state = claimable_state(cur)
+        if notified or new_state != state:
+            state = new_state
+            claimed, lease_seconds = claim_submissions(holder, limit)
+    return jsonify({"lease_seconds": lease_seconds, "submissions": [submission_info(r) for r in claimed]})
+
+@bp.route("/heartbeat", methods=["POST"])
+def autograde_heartbeat():
+    """Extends the leases of `holder` on the given submission ids and returns the ids it still holds;
+    leases that already expired may have been handed to another grader and are not renewed."""
+    if not request.args.get("APIKEY", "") == current_app.config["AUTOGRADE_APIKEY"]:
+        abort(403)
+    holder = request.form.get("holder")
+    ids = request.form.getlist("id", type=int)
+    if not holder:
+        abort(400)
+    lease_seconds = current_app.config.get("AUTOGRADE_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)
+    with transaction() as cur:
+        cur.executemany("""UPDATE autograde_leases SET expires = strftime('%s','now') + ?
+            WHERE submission_id = ? AND holder = ? AND expires > strftime('%s','now')""", [(lease_seconds, i, holder) for i in ids])
+        cur.execute("SELECT submission_id FROM autograde_leases WHERE holder = ? AND expires > strftime('%s','now')", (holder,))
+        held = {r[0] for r in cur.fetchall()}
+    return jsonify({"lease_seconds": lease_seconds, "held": [i for i in ids if i in held]})
+
+@bp.route("/release", methods=["POST"])
+def autograde_release():
+    """Returns claimed submissions that `holder` won't grade to the queue right away"""
+    if not request.args.get("APIKEY", "") == current_app.config["AUTOGRADE_APIKEY"]:
+        abort(403)
+    holder = request.form.get("holder")
+    if not holder:
+        abort(400)
+    get_db().executemany("DELETE FROM autograde_leases WHERE submission_id = ? AND holder = ?",
+        [(i, holder) for i in request.form.getlist("id", type=int)])
+    return jsonify({"result": "ok"})
 
 @bp.route("/queue")
 @tutor_required
@@ -99,7 +166,10 @@ def autograde_show_queue():
     for x in done:
         x['autograde_result'] = AutogradeStatus(x['autograde_result']).name
 
-    return render_template("autograde_queue.html", queue=queue, done=done, page=page, total_pages=total_pages)
+    cur.execute("SELECT * FROM autograde_leases WHERE expires > strftime('%s','now')")
+    leases = {r["submission_id"]: r for r in cur.fetchall()}
+
+    return render_template("autograde_queue.html", queue=queue, leases=leases, done=done, page=page, total_pages=total_pages)
 
 @bp.route("/<int:submission_id>", methods=["GET"])
 def grade(submission_id):
@@ -117,7 +187,9 @@ def grade(submission_id):
 
 def autograde_output(db_submission, start_time, output, force_fail):
     # Get and decode flags from output
-    flags = [check_flag(x) for x in find_flags(output)]
+    found = list(find_flags(output))
+    checked = check_flags_bulk(found)
+    flags = [checked[x][0] for x in found]
     # print("Found flags:", flags)
 
     # Is there at least one flag?
@@ -147,21 +219,33 @@ def grade_write(submission_id):
         db_submission = cur.fetchone()
         if not db_submission:
             abort(400) # The submission we want to update does not exist
+        if db_submission['autograde_result'] == AutogradeStatus.CANCELED.value:
+            # Superseded by a later submission while it was being graded
+            return jsonify({"result": AutogradeStatus.CANCELED.name})
+        holder = request.form.get("holder")
+        if holder:
+            cur.execute("SELECT holder FROM autograde_leases WHERE submission_id=? AND expires > strftime('%s','now')", (submission_id,))
+            lease = cur.fetchone()
+            if lease and lease["holder"] != holder:
+                # Our lease expired and another grader is working on it; its result counts
+                return jsonify({"result": "LEASE_LOST"}), 409
 
         start_time = float(request.form.get('start_time', db_submission['submission_time']))
         # bool("False") == "True"!?
         force_fail = request.form.get('force_fail', False) == "True"
         result = autograde_output(db_submission, start_time, output, force_fail)
 
-        cur.execute("UPDATE task_submissions SET autograde_output=?, autograde_result=? WHERE id=?", (output, result.value, submission_id))
-        cur.execute("""UPDATE task_grading SET deleted_time=strftime('%s', 'now') WHERE task_id=? and team_id=? and deleted_time IS NULL""", (db_submission['task_id'], db_submission['team_id'],))
-        cur.execute("""INSERT INTO task_grading (task_id, team_id, comment, points, corrector, internal_comment, created_time, deleted_time) 
-                     VALUES (?,?,?,?,?,'',strftime('%s','now'),NULL)""", 
-                    (db_submission['task_id'],
-                     db_submission['team_id'], 
-                     result.name, 
-                     db_submission['max_points'] if result == AutogradeStatus.OKAY else 0.0, 
-                     "Scoreboard - Grading Task"))
+        with transaction() as cur:
+            cur.execute("UPDATE task_submissions SET autograde_output=?, autograde_result=? WHERE id=?", (output, result.value, submission_id))
+            cur.execute("DELETE FROM autograde_leases WHERE submission_id=?", (submission_id,))
+            cur.execute("""UPDATE task_grading SET deleted_time=strftime('%s', 'now') WHERE task_id=? and team_id=? and deleted_time IS NULL""", (db_submission['task_id'], db_submission['team_id'],))
+            cur.execute("""INSERT INTO task_grading (task_id, team_id, comment, points, corrector, internal_comment, created_time, deleted_time) 
+                         VALUES (?,?,?,?,?,'',strftime('%s','now'),NULL)""", 
+                        (db_submission['task_id'],
+                         db_submission['team_id'], 
+                         result.name, 
+                         db_submission['max_points'] if result == AutogradeStatus.OKAY else 0.0, 
+                         "Scoreboard - Grading Task"))
         return jsonify({"result": result.name})
     else:
         abort(400)
@@ -1,8 +1,8 @@
 import csv
+import io
 import tempfile
-import base64
 import json
-from flask import Blueprint, request, render_template, send_file
+from flask import Blueprint, request, render_template, abort, Response, stream_with_context
 from .util import *
 from Crypto.Cipher import AES
 
@@ -11,6 +11,9 @@ class GradeCSVException(Exception):
 
 bp = Blueprint("grade-upload", __name__, url_prefix="/grade-upload")
 
+# Staged changesets that were never imported are dropped after this many seconds
+CHANGESET_LIFETIME = 24 * 3600
+
 @bp.route("", strict_slashes=False, methods=["POST", "GET"])
 @tutor_required
 def grade_upload():
@@ -23,63 +26,131 @@ def grade_upload():
                     # Check teams and tasks exist
                     cur = get_db().cursor()
                     cur.execute("SELECT team_id FROM teams")
-                    available_teams = [x[0] for x in cur.fetchall()]
+                    available_teams = {x[0] for x in cur.fetchall()}
                     
                     cur = get_db().cursor()
                     cur.execute("SELECT task_short FROM tasks")
-                    available_tasks = [x[0] for x in cur.fetchall()]
+                    available_tasks = {x[0] for x in cur.fetchall()}
 
                     # Interpret Uploaded Grades
                     l = read_grade_csv(tmp.name, available_teams, available_tasks)
 
                     # Get already present grades from DB
-                    cur.execute("SELECT * FROM task_grading g LEFT JOIN tasks t ON t.task_id = g.task_id WHERE deleted_time IS NULL")
+                    cur.execute("SELECT t.task_short, g.team_id, g.comment, g.internal_comment, g.points, g.corrector FROM task_grading g LEFT JOIN tasks t ON t.task_id = g.task_id WHERE deleted_time IS NULL")
                     grades_in_db = cur.fetchall()
 
                     delta = compare_grades(grades_in_db, l)
                     changed_records = sum(1 for x in delta if x[0] == "m")
                     new_records = sum(1 for x in delta if x[0] == "n")
                     ignored_records = len(l) - new_records - changed_records
-                    changeset = base64.b64encode(json.dumps(delta).encode()).decode()
+                    changeset = stage_changeset(delta)
 
                     return render_template("grade-upload-step2.html", changed_records=changed_records, new_records=new_records, changeset=changeset, ignored_records=ignored_records, new_grading=delta)
                 except GradeCSVException as e:
                     flash(e)
                     return render_template("grade-upload-step1.html")
         elif "changeset" in request.form:
-            changeset = json.loads(base64.b64decode(request.form["changeset"]))
-            cur = get_db().cursor()
-            for elm in changeset:
-                task_short, team_id, points, comment, internal_comment, corrector = elm[1]
-                task_id = cur.execute("SELECT task_id FROM tasks WHERE task_short=?", [task_short]).fetchone()[0]
-                if elm[0] == "m":
-                    cur.execute("UPDATE task_grading SET deleted_time=strftime('%s','now') WHERE task_id = ? and team_id = ? and deleted_time IS NULL", (task_id, team_id))
-                elif elm[0] != "n":
-                    raise Exception("Bad action in changeset!")
-                cur.execute("INSERT INTO task_grading (task_id, team_id, comment, internal_comment, points, corrector, created_time) VALUES (?,?,?,?,?,?,strftime('%s','now'))", (task_id, team_id, points, comment, internal_comment, corrector))
-            flash("Benotung importiert!", category="success")
+            start = time.monotonic()
+            try:
+                counts = apply_changeset(request.form["changeset"])
+            except GradeCSVException as e:
+                flash(e)
+                return render_template("grade-upload-step1.html")
+            if counts is None:
+                flash("Dieser Import ist abgelaufen oder wurde bereits übernommen.")
+            else:
+                new_records, changed_records = counts
+                flash(f"Benotung importiert! {new_records} neue und {changed_records} geänderte Benotungen in {time.monotonic() - start:.2f}s", category="success")
             return render_template("grade-upload-step1.html")
             #return changeset
     else:
         return render_template("grade-upload-step1.html")
 
+# Query parameters of /dl that restrict the export: parameter -> (column, type)
+GRADE_DL_FILTERS = {"task": ("t.task_short", str), "team": ("g.team_id", int), "corrector": ("g.corrector", str)}
+
 @bp.route("/dl")
 @tutor_required
 def grade_dl():
+    """Streams the current grading as CSV. The query parameters task (short name), team and
+    corrector restrict the export, each of them may be given multiple times."""
+    conditions = ["g.deleted_time IS NULL"]
+    params = []
+    for arg, (column, conv) in GRADE_DL_FILTERS.items():
+        values = request.args.getlist(arg)
+        if not values:
+            continue
+        try:
+            params.extend(conv(v) for v in values)
+        except ValueError:
+            abort(400, f"Invalid value for {arg}")
+        conditions.append(f"{column} IN ({','.join('?' * len(values))})")
+
     cur = get_db().cursor()
-    cur.execute("SELECT * FROM task_grading g  LEFT JOIN tasks t ON t.task_id=g.task_id WHERE deleted_time IS NULL ORDER BY order_num, task_id, team_id")
+    cur.execute(f"""SELECT t.task_short, g.team_id, g.points, g.comment, g.internal_comment, g.corrector
+        FROM task_grading g LEFT JOIN tasks t ON t.task_id=g.task_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY t.order_num, g.task_id, g.team_id""", params)
 
-    with tempfile.NamedTemporaryFile(mode="w+") as tmp:
-        w = csv.writer(tmp, delimiter=";", quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    def generate():
+        buf = io.StringIO()
+        w = csv.writer(buf, delimiter=";", quotechar='"', quoting=csv.QUOTE_MINIMAL)
         w.writerow(['task', 'team', 'points', 'comment', 'internal_comment', 'corrector'])
-        for r in cur.fetchall():
-            w.writerow([r['task_short'], r['team_id'], r['points'], r['comment'], r['internal_comment'], r['corrector']])
-            print(r)
-        tmp.flush()
-        return send_file(tmp.name, as_attachment=True, download_name="grading.csv")
+        while True:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            rows = cur.fetchmany(500)
+            if not rows:
+                break
+            w.writerows(rows)
+
+    return Response(stream_with_context(generate()), mimetype="text/csv",
+            headers={"Content-Disposition": "attachment; filename=grading.csv"})
 
 
+def stage_changeset(delta):
+    """Stores the delta from compare_grades for the import step and returns its id."""
+    changeset_id = os.urandom(16).hex()
+    cur = get_db().cursor()
+    cur.execute("DELETE FROM grade_changesets WHERE created_time < ?", (int(time.time()) - CHANGESET_LIFETIME,))
+    cur.execute("INSERT INTO grade_changesets (id, user_id, created_time, changeset) VALUES (?,?,?,?)",
+            (changeset_id, session["user-id"], int(time.time()), json.dumps(delta)))
+    return changeset_id
+
+def apply_changeset(changeset_id):
+    """Imports a staged changeset in a single transaction. Returns the number of new and changed
+    grades, or None if there is no such changeset (expired or already imported). Raises
+    GradeCSVException and imports nothing if one of its tasks was deleted or renamed since."""
+    with transaction() as cur:
+        cur.execute("SELECT changeset FROM grade_changesets WHERE id=?", (changeset_id,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        cur.execute("DELETE FROM grade_changesets WHERE id=?", (changeset_id,))
+        changeset = json.loads(row["changeset"])
+
+        cur.execute("SELECT task_short, task_id FROM tasks")
+        task_ids = {r["task_short"]: r["task_id"] for r in cur.fetchall()}
+        now = int(time.time())
+        replaced = []
+        inserted = []
+        for action, (task_short, team_id, comment, internal_comment, points, corrector), _ in changeset:
+            task_id = task_ids.get(task_short)
+            if task_id is None:
+                raise GradeCSVException(f"Import abgebrochen - Task {task_short} exisistiert nicht mehr in der DB, bitte die CSV erneut hochladen")
+            if action == "m":
+                replaced.append((now, task_id, team_id))
+            elif action != "n":
+                raise Exception("Bad action in changeset!")
+            inserted.append((task_id, team_id, comment, internal_comment, points, corrector, now))
+        cur.executemany("UPDATE task_grading SET deleted_time=? WHERE task_id = ? and team_id = ? and deleted_time IS NULL", replaced)
+        cur.executemany("INSERT INTO task_grading (task_id, team_id, comment, internal_comment, points, corrector, created_time) VALUES (?,?,?,?,?,?,?)", inserted)
+    return len(inserted) - len(replaced), len(replaced)
+
 def read_grade_csv(csvfile, available_teams, available_tasks):
+    """Parses a grading CSV into a list of (task_short, team_id, comment, internal_comment, points, corrector).
+    available_teams and available_tasks should be sets, they are checked for every row."""
     with open(csvfile, "r") as f:
         reader = csv.DictReader(f,delimiter=";")
         l = []
@@ -107,21 +178,23 @@ def read_grade_csv(csvfile, available_teams, available_tasks):
                 raise GradeCSVException(f"KeyError beim parsen in Zeile {reader.line_num}. Spalten gelöscht oder keine ; als Delimiter verwendet?!")
         return l
 
-def compare_single_grade(db_grades, i):
-    for x in db_grades:
-        if i[0] == x["task_short"] and i[1] == x["team_id"]:
-            if i[2] == x["comment"] and i[3] == x["internal_comment"] and i[4] == x["points"] and i[5] == x["corrector"]:
-                return ("u", None, None)
-            else:
-                return ("m", i, (x["task_short"], x["team_id"], x["comment"], x["internal_comment"], x["points"], x["corrector"]))
-    return ("n", i, None)
+def index_grades(db_grades):
+    """Maps (task_short, team_id) to the grading row."""
+    return {(x["task_short"], x["team_id"]): x for x in db_grades}
+
+def compare_single_grade(db_index, i):
+    x = db_index.get((i[0], i[1]))
+    if x is None:
+        return ("n", i, None)
+    if i[2] == x["comment"] and i[3] == x["internal_comment"] and i[4] == x["points"] and i[5] == x["corrector"]:
+        return ("u", None, None)
+    return ("m", i, (x["task_short"], x["team_id"], x["comment"], x["internal_comment"], x["points"], x["corrector"]))
 
 def compare_grades(db_grades, csv_grades):
+    db_index = index_grades(db_grades)
     r = []
     for i in csv_grades:
-        res = compare_single_grade(db_grades, i)
-        if res == ("u", None, None):
-            continue
-        else:
+        res = compare_single_grade(db_index, i)
+        if res[0] != "u":
             r.append(res)
     return r
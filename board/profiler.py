@@ -0,0 +1,293 @@
+from collections import deque, Counter
+import random
+import sys
+
+from flask import Blueprint, render_template, request, jsonify
+from .util import *
+
+# Query profiler: for a sampled fraction of requests (PROFILE_DB, PROFILE_DB_SAMPLE_RATE) the
+# connection handed out by get_db() is wrapped so that every statement is timed. The numbers are
+# aggregated per endpoint in memory, i.e. per gunicorn worker, and shown on /profiler.
+# Requests that aren't sampled get the plain connection and don't pay anything.
+#
+# In development and tests, DETECT_N_PLUS_ONE profiles every request and additionally remembers
+# where each statement was issued from, so that statements of the same shape executed over and
+# over within one request (typically queries inside a loop) are reported with their call sites.
+
+bp = Blueprint("profiler", __name__, url_prefix="/profiler")
+
+# Number of recent requests per endpoint the percentiles are computed from
+PROFILE_WINDOW = 1000
+
+_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SQL_WHITESPACE = re.compile(r"\s+")
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Returns the shape of a statement: literals and IN lists replaced by placeholders, whitespace collapsed."""
+    sql = _SQL_LITERALS.sub("?", sql)
+    sql = _SQL_WHITESPACE.sub(" ", sql).strip()
+    return _SQL_LISTS.sub("(?, ...)", sql)
+
+class ProfiledCursor:
+    """Cursor wrapper that reports execution and fetch times to a RequestProfile.
+    Fetch time and rows are attributed to the statement the cursor executed last."""
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+        self._sql = None
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        self._cursor.execute(sql, params)
+        self._sql = sql
+        self._profile.record(sql, time.perf_counter() - start, executed=1)
+        return self
+
+    def executemany(self, sql, params):
+        start = time.perf_counter()
+        self._cursor.executemany(sql, params)
+        self._sql = sql
+        self._profile.record(sql, time.perf_counter() - start, executed=1)
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._profile.record(self._sql, time.perf_counter() - start, rows=row is not None)
+        return row
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(*args)
+        self._profile.record(self._sql, time.perf_counter() - start, rows=len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._profile.record(self._sql, time.perf_counter() - start, rows=len(rows))
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self._cursor)
+        except StopIteration:
+            self._profile.record(self._sql, time.perf_counter() - start)
+            raise
+        self._profile.record(self._sql, time.perf_counter() - start, rows=1)
+        return row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class ProfiledConnection:
+    def __init__(self, db, profile):
+        self._db = db
+        self._profile = profile
+
+    def cursor(self):
+        return ProfiledCursor(self._db.cursor(), self._profile)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+def call_site(depth=3):
+    """Returns the innermost frames outside of this module as a tuple of (file, line, function)."""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    site = []
+    while frame is not None and len(site) < depth:
+        site.append((os.path.relpath(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+    return tuple(site)
+
+def format_call_site(site):
+    return " <- ".join(f"{filename}:{line} ({func})" for filename, line, func in site)
+
+class RequestProfile:
+    """Collects the statements of a single request."""
+    def __init__(self, sampled=True, track_callers=False):
+        self.start = time.perf_counter()
+        self.endpoint = None
+        # Only sampled profiles go into the statistics; the others exist for N+1 detection and tests
+        self.sampled = sampled
+        self.queries = 0
+        self.db_time = 0
+        self.rows = 0
+        # normalized sql -> [executions, total time, slowest single call, rows]
+        self.statements = {}
+        # normalized sql -> Counter of call sites, only with track_callers
+        self.callers = {} if track_callers else None
+        self._wrapped = None
+
+    def wrap(self, db):
+        if self._wrapped is None or self._wrapped._db is not db:
+            self._wrapped = ProfiledConnection(db, self)
+        return self._wrapped
+
+    def record(self, sql, duration, executed=0, rows=0):
+        self.queries += executed
+        self.db_time += duration
+        self.rows += rows
+        key = normalize_sql(sql) if sql is not None else "(no statement)"
+        stat = self.statements.get(key)
+        if stat is None:
+            stat = self.statements[key] = [0, 0, 0, 0]
+        stat[0] += executed
+        stat[1] += duration
+        stat[2] = max(stat[2], duration)
+        stat[3] += rows
+        if executed and self.callers is not None:
+            self.callers.setdefault(key, Counter())[call_site()] += 1
+
+    def repeated_statements(self, threshold):
+        """Returns (sql, executions, call sites) for all statements executed at least threshold times."""
+        return [(sql, stat[0], self.callers.get(sql, Counter()) if self.callers is not None else Counter())
+                for sql, stat in self.statements.items() if stat[0] >= threshold]
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.queries = deque(maxlen=PROFILE_WINDOW)
+        self.db_time = deque(maxlen=PROFILE_WINDOW)
+        self.duration = deque(maxlen=PROFILE_WINDOW)
+        self.rows = deque(maxlen=PROFILE_WINDOW)
+        # normalized sql -> [executions, total time, slowest single call, rows], over all sampled requests
+        self.statements = {}
+
+    def add(self, profile, duration):
+        self.requests += 1
+        self.queries.append(profile.queries)
+        self.db_time.append(profile.db_time)
+        self.duration.append(duration)
+        self.rows.append(profile.rows)
+        for sql, (count, total, slowest, rows) in profile.statements.items():
+            stat = self.statements.get(sql)
+            if stat is None:
+                stat = self.statements[sql] = [0, 0, 0, 0]
+            stat[0] += count
+            stat[1] += total
+            stat[2] = max(stat[2], slowest)
+            stat[3] += rows
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+# Repeated statements found by the N+1 detector, newest last
+_n_plus_one_reports = deque(maxlen=100)
+
+# Lists that receive every finished request profile, see count_queries()
+_collectors = []
+
+@contextmanager
+def count_queries():
+    """Profiles all requests handled inside the block and yields the list of their RequestProfiles
+    (with the endpoint set), e.g. to assert query budgets in tests:
+
+        with count_queries() as profiles:
+            client.get("/scoreboard")
+        assert profiles[0].queries <= 5
+    """
+    profiles = []
+    _collectors.append(profiles)
+    try:
+        yield profiles
+    finally:
+        _collectors.remove(profiles)
+
+def report_n_plus_one(profile, threshold):
+    for sql, count, sites in profile.repeated_statements(threshold):
+        site = format_call_site(sites.most_common(1)[0][0]) if sites else "unknown"
+        current_app.logger.warning("Possible N+1 query in %s: executed %d times from %s: %s", profile.endpoint, count, site, sql)
+        _n_plus_one_reports.append({"endpoint": profile.endpoint, "sql": sql, "count": count, "call_site": site, "time": int(time.time())})
+
+def percentiles(values, ps=(50, 90, 99)):
+    values = sorted(values)
+    if not values:
+        return {f"p{p}": None for p in ps} | {"max": None}
+    result = {f"p{p}": values[min(len(values) - 1, len(values) * p // 100)] for p in ps}
+    result["max"] = values[-1]
+    return result
+
+def get_profile_stats(top_statements=10):
+    """Returns the aggregated statistics of this worker, endpoints with the most DB time first.
+    Times are in milliseconds."""
+    ms = lambda values: [v * 1000 for v in values]
+    with _stats_lock:
+        result = []
+        for endpoint, s in _stats.items():
+            statements = sorted(s.statements.items(), key=lambda x: -x[1][1])[:top_statements]
+            result.append({
+                "endpoint": endpoint,
+                "requests": s.requests,
+                "queries": percentiles(s.queries),
+                "db_time_ms": percentiles(ms(s.db_time)),
+                "duration_ms": percentiles(ms(s.duration)),
+                "rows": percentiles(s.rows),
+                "total_db_time_ms": sum(s.db_time) * 1000,
+                "statements": [{"sql": sql, "count": count, "total_ms": total * 1000, "max_ms": slowest * 1000, "rows": rows}
+                    for sql, (count, total, slowest, rows) in statements],
+            })
+    return sorted(result, key=lambda x: -x["total_db_time_ms"])
+
+def reset_profile_stats():
+    with _stats_lock:
+        _stats.clear()
+        _n_plus_one_reports.clear()
+
+@bp.before_app_request
+def start_profile():
+    sampled = current_app.config.get("PROFILE_DB") and random.random() < current_app.config.get("PROFILE_DB_SAMPLE_RATE", 0.01)
+    detect = current_app.config.get("DETECT_N_PLUS_ONE")
+    if sampled or detect or _collectors:
+        g._db_profile = RequestProfile(sampled=sampled, track_callers=detect)
+
+@bp.teardown_app_request
+def finish_profile(exc):
+    profile = g.pop("_db_profile", None)
+    if profile is None:
+        return
+    duration = time.perf_counter() - profile.start
+    profile.endpoint = request.endpoint or "(unmatched)"
+    for profiles in _collectors:
+        profiles.append(profile)
+    if profile.callers is not None:
+        report_n_plus_one(profile, current_app.config.get("N_PLUS_ONE_THRESHOLD", 5))
+    if not profile.sampled:
+        return
+    with _stats_lock:
+        stats = _stats.get(profile.endpoint)
+        if stats is None:
+            stats = _stats[profile.endpoint] = EndpointStats()
+        stats.add(profile, duration)
+
+@bp.route("/")
+@admin_required
+def profiler():
+    return render_template("profiler.html", stats=get_profile_stats(), pid=os.getpid(), window=PROFILE_WINDOW, n_plus_one=list(_n_plus_one_reports),
+            enabled=current_app.config.get("PROFILE_DB"), sample_rate=current_app.config.get("PROFILE_DB_SAMPLE_RATE", 0.01))
+
+@bp.route("/json")
+@admin_required
+def profiler_json():
+    return jsonify({"pid": os.getpid(), "endpoints": get_profile_stats(), "n_plus_one": list(_n_plus_one_reports)})
+
+@bp.route("/reset", methods=["POST"])
+@admin_required
+def profiler_reset():
+    reset_profile_stats()
+    flash("Profiler statistics of this worker have been reset.")
+    return redirect("./")
@@ -0,0 +1,95 @@
+import ast
+import glob
+import os
+import re
+import sqlite3
+
+# Finds the SQL statements used in the code base and checks their query plans for full table scans.
+
+# Tables that only ever hold a handful of rows (or one per pending job); scanning them is fine
+SMALL_TABLES = ["tasks", "tutorium", "timesheet_tasks", "scoreboard_cache", "task_stats", "autograde_queue", "autograde_leases"]
+
+SQL_KEYWORDS = {"left", "right", "inner", "outer", "cross", "join", "on", "using", "where", "group", "order", "limit", "as", "set", "natural", "union", "having", "window"}
+
+def find_statements(paths):
+    """Yields (filename, line, sql) for every constant SQL string passed to execute(),
+    executemany() or queue_write(). Statements built with f-strings yield sql=None."""
+    for filename in paths:
+        with open(filename) as f:
+            tree = ast.parse(f.read(), filename)
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or not node.args:
+                continue
+            func = node.func
+            name = func.attr if isinstance(func, ast.Attribute) else func.id if isinstance(func, ast.Name) else None
+            if name not in ("execute", "executemany", "queue_write"):
+                continue
+            arg = node.args[0]
+            if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                yield filename, node.lineno, arg.value
+            elif isinstance(arg, ast.JoinedStr):
+                yield filename, node.lineno, None
+
+def default_paths():
+    return ["app.py"] + sorted(glob.glob(os.path.join("board", "*.py")))
+
+def create_schema():
+    """Returns an in-memory database with the schema of all migrations in db/."""
+    db = sqlite3.connect(":memory:")
+    scripts = {int(m.group(1)): f for f in os.listdir("db") if (m := re.match(r"(\d+)\.sql", f))}
+    for version in sorted(scripts):
+        with open(os.path.join("db", scripts[version])) as f:
+            db.executescript(f.read())
+    return db
+
+def dummy_parameters(sql):
+    # Ignore placeholder-like text inside string literals, e.g. strftime('%s', ...)
+    stripped = re.sub(r"'[^']*'|\"[^\"]*\"", "", sql)
+    named = re.findall(r"[:@$]([A-Za-z_]\w*)", stripped)
+    if named:
+        return {n: None for n in named}
+    numbered = [int(n) for n in re.findall(r"\?(\d+)", stripped)]
+    if numbered:
+        return [None] * max(numbered)
+    return [None] * stripped.count("?")
+
+def table_aliases(sql):
+    aliases = {}
+    for table, alias in re.findall(r"(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?", sql, re.IGNORECASE):
+        aliases[table] = table
+        if alias and alias.lower() not in SQL_KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+def full_scans(db, sql):
+    """Returns the tables the statement scans without using an index."""
+    tables = {r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    aliases = table_aliases(sql)
+    scans = []
+    for row in db.execute("EXPLAIN QUERY PLAN " + sql, dummy_parameters(sql)):
+        detail = row[3]
+        m = re.match(r"SCAN (\w+)", detail)
+        if not m or "INDEX" in detail:
+            continue
+        table = aliases.get(m.group(1), m.group(1))
+        # Scans of subqueries and CTEs show up under their alias; their inner scans are reported separately
+        if table in tables:
+            scans.append(table)
+    return scans
+
+def check_query_plans(db, paths, ignored_tables):
+    """Returns a list of (filename, line, sql, problem) for all statements that scan a table
+    or can't be checked at all."""
+    problems = []
+    for filename, line, sql in find_statements(paths):
+        if sql is None:
+            problems.append((filename, line, None, "dynamic SQL (f-string), can't be checked"))
+            continue
+        try:
+            scans = [t for t in full_scans(db, sql) if t not in ignored_tables]
+        except sqlite3.Error as e:
+            problems.append((filename, line, sql, f"can't explain: {e}"))
+            continue
+        if scans:
+            problems.append((filename, line, sql, "full table scan of " + ", ".join(scans)))
+    return problems
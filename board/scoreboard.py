@@ -0,0 +1,138 @@
+from collections import defaultdict
+import json
+
+from flask import render_template
+from markupsafe import Markup
+
+from .util import *
+
+# The scoreboard ranks teams by the position in which they solved each task (first solve = 1, ...).
+# Instead of replaying all of flag_submissions on every page hit, the first solve of every
+# (team, task) pair and its position are kept in scoreboard_solves and updated on every new flag.
+#
+# On top of that, the computed scoreboard (ranking, team names and visible tasks) is stored in
+# scoreboard_cache so that all gunicorn workers share one computation per change. Everything that
+# changes what the scoreboard shows has to call bump_scoreboard_version().
+
+# Last snapshot loaded by this worker, so unchanged snapshots aren't even deserialized again
+_snapshot_memo = {"snapshot_id": None, "snapshot": None}
+
+def bump_scoreboard_version(cur=None):
+    cur = cur or get_db().cursor()
+    cur.execute("UPDATE scoreboard_cache SET version = version + 1")
+
+def record_solve(cur, team_id, task_id, flag_time):
+    """Updates the scoreboard state for a freshly inserted flag submission.
+    Has to run inside the transaction that inserted the flag."""
+    cur.execute("SELECT flag_time, position FROM scoreboard_solves WHERE team_id=? AND task_id=?", (team_id, task_id))
+    existing = cur.fetchone()
+    if existing:
+        if existing["flag_time"] <= flag_time:
+            # Team already solved this task earlier; nothing changes
+            return
+        # Team submitted an older flag than the one it solved the task with; move its solve forward
+        cur.execute("DELETE FROM scoreboard_solves WHERE team_id=? AND task_id=?", (team_id, task_id))
+        cur.execute("UPDATE scoreboard_solves SET position = position - 1 WHERE task_id=? AND position > ?", (task_id, existing["position"]))
+
+    cur.execute("SELECT COUNT(*) FROM scoreboard_solves WHERE task_id=? AND flag_time <= ?", (task_id, flag_time))
+    position = cur.fetchone()[0] + 1
+    cur.execute("UPDATE scoreboard_solves SET position = position + 1 WHERE task_id=? AND flag_time > ?", (task_id, flag_time))
+    cur.execute("INSERT INTO scoreboard_solves (team_id, task_id, flag_time, position) VALUES (?,?,?,?)", (team_id, task_id, flag_time, position))
+    bump_scoreboard_version(cur)
+
+def rebuild_scoreboard():
+    """Recomputes the scoreboard state from the flag submission log.
+    Used when teams get deleted, since their solves no longer count for the positions of others."""
+    with transaction() as cur:
+        cur.execute("DELETE FROM scoreboard_solves")
+        cur.execute("""INSERT INTO scoreboard_solves (team_id, task_id, flag_time, position)
+            SELECT team_id, task_id, flag_time, ROW_NUMBER() OVER (PARTITION BY task_id ORDER BY flag_time, first_rowid)
+            FROM (
+                SELECT s.team_id, s.task_id, MIN(s.flag_time) AS flag_time, MIN(s.rowid) AS first_rowid
+                FROM flag_submissions s
+                LEFT JOIN teams t ON s.team_id = t.team_id
+                WHERE t.deleted IS NULL
+                GROUP BY s.team_id, s.task_id
+            )""")
+        bump_scoreboard_version(cur)
+
+def get_scoreboard(tasks):
+    """Returns the ranked scoreboard as a list of (team_id, {task_id: position}, score, solved)
+    for the given (visible) tasks."""
+    cur = get_db().cursor()
+    cur.execute("SELECT team_id, task_id, position FROM scoreboard_solves")
+
+    visible = {k["task_id"] for k in tasks}
+    state = defaultdict(lambda: {k["task_id"]: 0 for k in tasks})
+    for r in cur:
+        if r["task_id"] in visible:
+            state[r["team_id"]][r["task_id"]] = r["position"]
+
+    return sorted(
+        [(k, v, sum(v.values()), sum(1 for x in v.values() if x > 0)) for k, v in state.items()],
+        key=lambda x: (-x[3], x[2])
+    )
+
+def compute_scoreboard_snapshot(cur):
+    cur.execute("SELECT task_id, task_short FROM tasks WHERE from_date < strftime('%s','now') ORDER BY order_num")
+    tasks = [dict(r) for r in cur.fetchall()]
+
+    cur.execute("""SELECT
+    t.team_id,
+    CASE WHEN tt.teamname IS NULL THEN 'Team ' || tt.team_id ELSE tt.teamname END as teamname,
+    GROUP_CONCAT(u.vorname || ' ' || u.nachname, ', ') as member
+    FROM team_members t
+    LEFT JOIN users u ON u.id = t.member_id
+    LEFT JOIN teams tt ON t.team_id = tt.team_id
+    WHERE tt.deleted IS NUll
+    GROUP BY t.team_id""")
+    teams = {res["team_id"]: {"teamname": res["teamname"], "member": res["member"]} for res in cur.fetchall()}
+
+    # The set of visible tasks changes once the next task is released
+    cur.execute("SELECT MIN(from_date) FROM tasks WHERE from_date >= strftime('%s','now')")
+    valid_until = cur.fetchone()[0]
+
+    scoreboard = get_scoreboard(tasks)
+    # The anonymous table body is the same for every student, so it is only rendered once per snapshot
+    fragment = render_template("scoreboard_rows.html", scoreboard=scoreboard, teams=teams, tasks=tasks, show_names=False)
+    return {"tasks": tasks, "scoreboard": scoreboard, "teams": teams, "fragment": fragment}, valid_until
+
+def _decode_snapshot(data):
+    snapshot = json.loads(data)
+    # JSON turns the integer ids used as keys into strings
+    snapshot["teams"] = {int(k): v for k, v in snapshot["teams"].items()}
+    snapshot["scoreboard"] = [(team_id, {int(k): v for k, v in state.items()}, score, solved) for team_id, state, score, solved in snapshot["scoreboard"]]
+    snapshot["fragment"] = Markup(snapshot["fragment"])
+    return snapshot
+
+def _snapshot_valid(row):
+    return row["snapshot_version"] == row["version"] and (row["valid_until"] is None or time.time() <= row["valid_until"])
+
+def get_scoreboard_snapshot():
+    """Returns the current scoreboard as a dict with keys "id", "tasks", "scoreboard", "teams" and
+    "fragment" (pre-rendered anonymous table body), computing it only if no worker has done so for
+    the current scoreboard version. The id changes whenever the content does."""
+    cur = get_db().cursor()
+    cur.execute("SELECT version, snapshot_version, snapshot_id, valid_until FROM scoreboard_cache")
+    row = cur.fetchone()
+    if _snapshot_valid(row) and row["snapshot_id"] == _snapshot_memo["snapshot_id"]:
+        return _snapshot_memo["snapshot"]
+
+    # Serialize recomputation so that concurrent workers don't all compute the same snapshot
+    with transaction() as cur:
+        cur.execute("SELECT * FROM scoreboard_cache")
+        row = cur.fetchone()
+        if _snapshot_valid(row):
+            snapshot_id = row["snapshot_id"]
+            snapshot = _decode_snapshot(row["snapshot"])
+        else:
+            snapshot_id = os.urandom(8).hex()
+            snapshot, valid_until = compute_scoreboard_snapshot(cur)
+            snapshot["id"] = snapshot_id
+            cur.execute("UPDATE scoreboard_cache SET snapshot_version=?, snapshot_id=?, valid_until=?, snapshot=?",
+                    (row["version"], snapshot_id, valid_until, json.dumps(snapshot)))
+            snapshot["fragment"] = Markup(snapshot["fragment"])
+
+    _snapshot_memo["snapshot_id"] = snapshot_id
+    _snapshot_memo["snapshot"] = snapshot
+    return snapshot
@@ -0,0 +1,157 @@
+import shutil
+import struct
+
+from .util import *
+
+# Submissions are stored content-addressed: the file is named after its SHA-256 in
+# submissions/blobs/<first two hex digits>/, and task_submissions.filepath points to it.
+# Teams re-uploading the same file before the deadline therefore don't use any extra space.
+
+SUBMISSION_DIR = "submissions"
+BLOB_DIR = os.path.join(SUBMISSION_DIR, "blobs")
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_SUBMISSION_SIZE = 20 * 1024 * 1024
+
+# Leading bytes an upload with the given extension has to start with (any of them)
+MAGIC_BYTES = {
+    ".zip": (b"PK\x03\x04", b"PK\x05\x06"),
+    ".pdf": (b"%PDF-",),
+    ".gz": (b"\x1f\x8b",),
+    ".tar.gz": (b"\x1f\x8b",),
+    ".tgz": (b"\x1f\x8b",),
+}
+# Uploads with these extensions must not contain NUL bytes
+TEXT_EXTENSIONS = {".py", ".txt", ".md", ".c", ".h", ".s", ".sh", ".json", ".csv"}
+
+# End of central directory record of a ZIP file: it is followed only by the archive comment
+# (at most 64KiB), so it is always found in the last ZIP_TAIL_SIZE bytes.
+ZIP_EOCD = struct.Struct("<4s4H2LH")
+ZIP_TAIL_SIZE = ZIP_EOCD.size + 0xFFFF
+
+class SubmissionRejected(Exception):
+    pass
+
+class SubmissionValidator:
+    """Checks an upload chunk by chunk while it is being copied: size limit, magic bytes for the
+    file extension and, for ZIP files, the end of central directory record.
+    Both methods raise SubmissionRejected with a message for the user."""
+    def __init__(self, ext, max_size=None):
+        self.ext = ext.lower()
+        self.max_size = max_size
+        self.size = 0
+        self.head = b""
+        self.tail = bytearray() if self.ext == ".zip" else None
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise SubmissionRejected(f"Die Datei ist zu groß (maximal {self.max_size // (1024 * 1024)} MiB)!")
+        if len(self.head) < 8:
+            self.head += chunk[:8 - len(self.head)]
+        if self.ext in TEXT_EXTENSIONS and b"\0" in chunk:
+            raise SubmissionRejected("Das ist keine Textdatei!")
+        if self.tail is not None:
+            self.tail += chunk
+            del self.tail[:-ZIP_TAIL_SIZE]
+
+    def close(self):
+        if not self.size:
+            raise SubmissionRejected("Leere Datei hochgeladen!")
+        magic = MAGIC_BYTES.get(self.ext)
+        if magic and not self.head.startswith(magic):
+            raise SubmissionRejected("Das ist keine ZIP-Datei!" if self.ext == ".zip" else f"Das ist keine {self.ext}-Datei!")
+        if self.tail is not None and not self._check_zip_directory():
+            raise SubmissionRejected("Die ZIP-Datei ist unvollständig oder beschädigt!")
+
+    def _check_zip_directory(self):
+        pos = self.tail.rfind(b"PK\x05\x06")
+        if pos < 0 or pos + ZIP_EOCD.size > len(self.tail):
+            return False
+        _, disk, cd_disk, disk_entries, entries, cd_size, cd_offset, comment_len = ZIP_EOCD.unpack_from(self.tail, pos)
+        if pos + ZIP_EOCD.size + comment_len > len(self.tail):
+            return False
+        if 0xFFFF in (disk_entries, entries) or 0xFFFFFFFF in (cd_size, cd_offset):
+            # ZIP64, the actual values are in a separate record
+            return True
+        eocd_offset = self.size - len(self.tail) + pos
+        # The directory has to end right before the EOCD record
+        if disk != 0 or cd_disk != 0 or disk_entries != entries or cd_size < entries * 46 or cd_offset + cd_size != eocd_offset:
+            return False
+        tail_start = self.size - len(self.tail)
+        if cd_offset >= tail_start and entries:
+            return self.tail[cd_offset - tail_start:cd_offset - tail_start + 4] == b"PK\x01\x02"
+        return True
+
+def blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], digest)
+
+def _move_to_blob(tmp_path, digest):
+    path = blob_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+    return path
+
+def store_submission(stream, validator=None):
+    """Copies an uploaded file into the blob store, hashing and validating it on the way.
+    Nothing is stored if the validator rejects the file (SubmissionRejected is raised).
+    Returns (filepath, sha256 hex digest)."""
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    # Not mkstemp: that creates the file with mode 0600, uploads used to be stored with the umask's default
+    tmp_path = os.path.join(BLOB_DIR, f".upload-{os.urandom(8).hex()}")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        h = hashlib.sha256()
+        with os.fdopen(fd, "wb") as out:
+            while chunk := stream.read(CHUNK_SIZE):
+                if validator:
+                    validator.feed(chunk)
+                h.update(chunk)
+                out.write(chunk)
+        if validator:
+            validator.close()
+        digest = h.hexdigest()
+        return _move_to_blob(tmp_path, digest), digest
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            h.update(chunk)
+    return h.hexdigest()
+
+def migrate_submissions(dry_run=False):
+    """Moves submissions stored under their own name into the blob store and yields
+    (filepath, sha256 or None if missing, duplicate, size) for every file."""
+    cur = get_db().cursor()
+    # Updated by id below, filepath isn't indexed
+    cur.execute("SELECT id, filepath FROM task_submissions WHERE sha256 IS NULL ORDER BY id")
+    ids_by_path = {}
+    for r in cur.fetchall():
+        ids_by_path.setdefault(r["filepath"], []).append(r["id"])
+    seen = set()
+    for path, ids in ids_by_path.items():
+        if not os.path.exists(path):
+            yield path, None, False, 0
+            continue
+        size = os.path.getsize(path)
+        digest = hash_file(path)
+        target = blob_path(digest)
+        duplicate = digest in seen or os.path.exists(target)
+        seen.add(digest)
+        if not dry_run:
+            if not duplicate:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # Keep the original until the database points to the blob
+                try:
+                    os.link(path, target)
+                except OSError:
+                    shutil.copy2(path, target)
+            get_db().executemany("UPDATE task_submissions SET filepath=?, sha256=? WHERE id=?", [(target, digest, id) for id in ids])
+            os.remove(path)
+        yield path, digest, duplicate, size
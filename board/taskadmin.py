@@ -1,13 +1,14 @@
 import io
-import tempfile
 import json
 import pathlib
 import glob
-from flask import current_app, Blueprint, request, render_template, abort, send_from_directory, send_file, jsonify, url_for
+from flask import current_app, Blueprint, request, render_template, abort, send_from_directory, send_file, jsonify, url_for, Response, stream_with_context
 from .util import *
+from .scoreboard import bump_scoreboard_version
 from Crypto.Cipher import AES
 import zipfile
 import time
+import re
 import markdown
 import subprocess
 
@@ -26,21 +27,24 @@ def render_markdown(md):
 
 TIMEFORMAT = "%Y-%m-%dT%H:%M"
 
-def render_taskadmin(edit_record):
+def get_task_overview():
+    """Returns all tasks with their submission, flag, grading and feedback statistics."""
     cur = get_db().cursor()
-    cur.execute("SELECT * FROM tasks ORDER BY order_num")
-    tasks = [dict(x) for x in cur.fetchall()]
-    for t in tasks:
-        cur.execute("SELECT COUNT(DISTINCT team_id) FROM task_submissions WHERE task_id=?", (t["task_id"],))
-        t["submissions_received"] = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(DISTINCT team_id) FROM flag_submissions WHERE task_id=?", (t["task_id"],))
-        t["flags_received"] = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM task_grading WHERE task_id=? and deleted_time IS NULL", (t["task_id"],))
-        t["grading_done"] = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM task_grading g LEFT JOIN tasks t ON t.task_id = g.task_id WHERE g.task_id=? and points=max_points and deleted_time IS NULL", (t["task_id"],))
-        t["full_points"] = cur.fetchone()[0]
-        cur.execute("SELECT AVG(rating), COUNT(rating) FROM task_feedback WHERE task_id=?", (t["task_id"],))
-        t["avg_rating"], t["number_of_ratings"] = cur.fetchone()
+    # The counters are maintained by triggers, see board/taskstats.py
+    cur.execute("""SELECT t.*,
+        COALESCE(s.submission_teams, 0) AS submissions_received,
+        COALESCE(s.flag_teams, 0) AS flags_received,
+        COALESCE(s.gradings, 0) AS grading_done,
+        COALESCE(s.full_point_gradings, 0) AS full_points,
+        CASE WHEN s.ratings > 0 THEN s.rating_sum / s.ratings END AS avg_rating,
+        COALESCE(s.ratings, 0) AS number_of_ratings
+        FROM tasks t
+        LEFT JOIN task_stats s ON s.task_id = t.task_id
+        ORDER BY t.order_num""")
+    return [dict(x) for x in cur.fetchall()]
+
+def render_taskadmin(edit_record):
+    tasks = get_task_overview()
     return render_template("task-admin/list.html", tasks=tasks, edit=edit_record)
 
 @bp.route("", strict_slashes=False, methods=["GET"])
@@ -96,6 +100,9 @@ def insert_or_update_task(task_id=None):
     else:
         sql = "UPDATE tasks SET {} WHERE task_id=:task_id".format(",".join(f"{k}=:{k}" for k in params.keys()))
         cur.execute(sql, params)
+        invalidate_task_key_cache(task_id)
+    # Task names, order and release times are shown on the scoreboard
+    bump_scoreboard_version(cur)
     
     if "fileupload" in request.files and request.files["fileupload"].filename:
         f = request.files["fileupload"]
@@ -222,30 +229,103 @@ def tasks_from_repo():
         dirs.append(task_data)
     return render_template("task-admin/repo.html", tasks=sorted(dirs, key=lambda x: x['path']))
 
+def query_submissions(cur, task_shorts=None, latest=False, due=None):
+    """Runs a query for the submissions of the given tasks (all if None) ordered by task and team.
+    latest: only the newest submission of every team per task.
+    due: only submissions before this timestamp, or "task" for the due date of each task."""
+    conditions = []
+    params = []
+    if task_shorts:
+        conditions.append(f"t.task_short IN ({','.join('?' * len(task_shorts))})")
+        params.extend(task_shorts)
+    if due == "task":
+        conditions.append("s.submission_time < t.due_date")
+    elif due is not None:
+        conditions.append("s.submission_time < ?")
+        params.append(due)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    cur.execute(f"""SELECT * FROM (
+            SELECT s.*, t.task_short, t.order_num,
+            ROW_NUMBER() OVER (PARTITION BY s.task_id, s.team_id ORDER BY s.submission_time DESC, s.id DESC) AS newest
+            FROM task_submissions s
+            LEFT JOIN tasks t ON t.task_id = s.task_id
+            {where})
+        {"WHERE newest = 1" if latest else ""}
+        ORDER BY order_num, task_id, team_id, submission_time""", params)
+    return cur
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable sink for ZipFile that collects the written bytes until they are sent."""
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+ZIP_CHUNK_SIZE = 256 * 1024
+
 @bp.route("/dl")
 @tutor_required
 def download_submissions():
-    cur = get_db().cursor()
-    cur.execute("SELECT * FROM task_submissions s LEFT JOIN tasks t ON t.task_id = s.task_id")
-    with tempfile.NamedTemporaryFile() as tmpzip:
-        with zipfile.ZipFile(tmpzip.name, "w") as z:
-            for f in cur.fetchall():
+    """Streams a ZIP of the submissions while reading the files, so the download starts right away.
+    Query parameters: task (short name, may be repeated), latest=1 for only the newest submission
+    of every team, due=YYYY-mm-dd-HH-MM or due=task to drop submissions after the deadline."""
+    due = request.args.get("due")
+    if due and due != "task":
+        try:
+            due = int(time.mktime(time.strptime(due, "%Y-%m-%d-%H-%M")))
+        except ValueError:
+            abort(400, "due must be YYYY-mm-dd-HH-MM or 'task'")
+    tasks = request.args.getlist("task")
+    cur = query_submissions(get_db().cursor(), tasks, bool(request.args.get("latest")), due)
+
+    def generate():
+        stream = _ZipStream()
+        # Submissions are mostly archives already, so they are stored without compression
+        with zipfile.ZipFile(stream, "w") as z:
+            for f in cur:
+                # Files are stored under their hash, so name them after the submission and the uploaded file
+                original_name = os.path.basename(f["original_name"].replace("\\", "/"))
+                arcname = f"{f['task_short']}/team-{f['team_id']}/{f['id']}-{original_name}"
                 try:
-                    z.write(f["filepath"], f"{f['task_short']}/team-{f['team_id']}/{os.path.basename(f['filepath'])}")
+                    src = open(f["filepath"], "rb")
                 except FileNotFoundError:
-                    print(f["filepath"], "not found")
-        return send_file(tmpzip.name, as_attachment=True, download_name="submissions.zip")
-        #return send_from_directory(directory="submissions", filename=filename)
+                    current_app.logger.warning("Submission %s not found", f["filepath"])
+                    continue
+                with src, z.open(zipfile.ZipInfo.from_file(f["filepath"], arcname), "w") as dst:
+                    while chunk := src.read(ZIP_CHUNK_SIZE):
+                        dst.write(chunk)
+                        yield stream.pop()
+                yield stream.pop()
+        yield stream.pop()
+
+    # Task names come from the query string; keep the header value to characters that need no quoting
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", f"submissions-{'-'.join(tasks)}.zip") if tasks else "submissions.zip"
+    return Response(stream_with_context(generate()), mimetype="application/zip",
+            headers={"Content-Disposition": f"attachment; filename={name}"})
 
 @bp.route("/delete", methods=["POST"])
 @admin_required
 def task_delete():
     cur = get_db().cursor()
-    cur.execute("SELECT COUNT(*) FROM flag_submissions WHERE task_id=?", (request.form["tasknum"],))
-    if cur.fetchone()[0] > 0:
+    cur.execute("SELECT flag_teams FROM task_stats WHERE task_id=?", (request.form["tasknum"],))
+    flag_teams = cur.fetchone()
+    if flag_teams and flag_teams[0] > 0:
         flash("This task already has submitted flags and can therefore not get deleted!")
         return redirect("/taskadmin")
     cur.execute("DELETE FROM tasks WHERE task_id=?", (request.form["tasknum"],))
+    invalidate_task_key_cache(int(request.form["tasknum"]))
+    bump_scoreboard_version(cur)
 
     return redirect("/taskadmin")
 
@@ -7,6 +7,8 @@ from Crypto.Cipher import Blowfish
 from flask import Blueprint, render_template, send_from_directory, abort, request, send_file, jsonify, current_app
 
 from .util import *
+from .autograde import notify_new_submission
+from .submissions import store_submission, SubmissionValidator, SubmissionRejected, DEFAULT_MAX_SUBMISSION_SIZE
 
 filetypes_desc = {
     ".py": "Python Script/Exploit (.py)",
@@ -184,7 +186,7 @@ def task_download(task_id):
     r = cur.fetchone()
     if r["from_date"] > time.time() and not is_tutor():
         abort(404)
-    cur.execute("INSERT INTO tasks_download_log VALUES (?, ?, datetime('now', 'localtime'))", [session["user-id"],task_id])
+    queue_write("INSERT INTO tasks_download_log VALUES (?, ?, datetime('now', 'localtime'))", [session["user-id"],task_id])
     # TODO insert team code. Hard if we don't know if this is .zip or .tar or .tar.gz or .py or...
     return send_from_directory("tasks", path=r["task_short"], as_attachment=True, download_name=r["filename"])
 
@@ -202,41 +204,39 @@ def task_upload(task_id):
             flash("Du benötigst einen Team-Partner für die Abgabe der Übungsaufgaben!")
             return redirect(f"/tasks/{task_id}")
 
+        max_size = current_app.config.get("MAX_SUBMISSION_SIZE", DEFAULT_MAX_SUBMISSION_SIZE)
+        # Don't even parse request bodies that can't contain an acceptable file
+        if request.content_length and request.content_length > max_size + 64 * 1024:
+            flash(f"Die Datei ist zu groß (maximal {max_size // (1024 * 1024)} MiB)!")
+            return redirect(f"/tasks/{task_id}")
+
         if "fileupload" not in request.files:
             flash("Keine Datei hochgeladen!")
             return redirect(f"/tasks/{task_id}")
         f = request.files["fileupload"]
 
-        if not any(f.filename.endswith(ext) for ext in r['file_extensions'].split(",")):
+        ext = next((ext for ext in r['file_extensions'].split(",") if f.filename.endswith(ext)), None)
+        if ext is None:
             flash("This file extension is not valid for uploads to this task!")
             return redirect(f"/tasks/{task_id}")
 
-        ext = f.filename.split(".")[-1]
-
         if r["due_date"] + current_app.config["SUBMISSION_GRACE_PERIOD"] < time.time():
             flash("Die Abgabefrist ist abgelaufen!")
             return redirect(f"/tasks/{task_id}")
 
-        filename = "task-{}-team{}-{}.{}".format(r["task_short"], team_id, datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S"), ext)
-        final_path = os.path.join("submissions", filename)
-        f.save(final_path)
-        f.close()
-
-        with open(final_path, "rb") as fu:
-            first_two_bytes = fu.read(2)
-            if not first_two_bytes:
-                flash("Leere Datei hochgeladen!")
-                os.remove(final_path)
-                return redirect(f"/tasks/{task_id}")
-            if ext == "zip" and not b"PK" == first_two_bytes:
-                flash("Das ist keine ZIP-Datei!")
-                os.remove(final_path)
-                return redirect(f"/tasks/{task_id}")
+        try:
+            final_path, digest = store_submission(f.stream, SubmissionValidator(ext, max_size))
+        except SubmissionRejected as e:
+            flash(str(e))
+            return redirect(f"/tasks/{task_id}")
+        finally:
+            f.close()
 
         # Create a log record inside the database
         cur = get_db().cursor()
-        cur.execute("INSERT INTO task_submissions (task_id, team_id, user_id, submission_time, filepath,original_name) VALUES (?,?,?,strftime('%s','now'),?,?)",
-		(task_id, team_id, session["user-id"], final_path, f.filename))
+        cur.execute("INSERT INTO task_submissions (task_id, team_id, user_id, submission_time, filepath, original_name, sha256) VALUES (?,?,?,strftime('%s','now'),?,?,?)",
+		(task_id, team_id, session["user-id"], final_path, f.filename, digest))
+        notify_new_submission()
 
         flash("Deine Abgabe wurde erfolgreich entgegengenommen", category="success")
         return redirect(f"/tasks/{task_id}")
@@ -277,8 +277,8 @@ def update_task_status():
     if not output:
         abort(400) # No output passed in the request
 
-    for flag in find_flags(output):
-        result = check_flag(flag)
+    up_tasks = set()
+    for flag, (result, _) in check_flags_bulk(find_flags(output)).items():
         if not result:
             # Invalid flag
             # Since we don't have UUIDs anymore (they map badly for tasks with multiple flags),
@@ -286,8 +286,8 @@ def update_task_status():
             log_event(None, Category.TASK_STATUS, f"Received bad flag {flag} in status update")
         else:
             # Valid flag for something
-            print(result['task_id'])
-            set_task_status(result["task_id"], True)
+            up_tasks.add(result["task_id"])
+    set_tasks_status(up_tasks, True)
     return '', 204 # No content
 
 
@@ -0,0 +1,49 @@
+from .util import *
+
+# Per-task counters (teams with submissions/flags, gradings, full-point gradings, ratings) are
+# kept in task_stats by triggers on the underlying tables (see db/30.sql), so overview pages read
+# one row per task instead of aggregating over all submissions. The functions here recompute them
+# from scratch to check or repair the maintained values.
+
+TASK_STATS_COLUMNS = ["submission_teams", "flag_teams", "gradings", "full_point_gradings", "ratings", "rating_sum"]
+
+def compute_task_stats(cur):
+    """Returns {task_id: {column: value}} computed from the underlying tables."""
+    cur.execute("""SELECT t.task_id,
+        COALESCE(s.submission_teams, 0) AS submission_teams,
+        COALESCE(f.flag_teams, 0) AS flag_teams,
+        COALESCE(g.gradings, 0) AS gradings,
+        COALESCE(g.full_point_gradings, 0) AS full_point_gradings,
+        COALESCE(r.ratings, 0) AS ratings,
+        COALESCE(r.rating_sum, 0) AS rating_sum
+        FROM tasks t
+        LEFT JOIN (SELECT task_id, COUNT(DISTINCT team_id) AS submission_teams FROM task_submissions GROUP BY task_id) s ON s.task_id = t.task_id
+        LEFT JOIN (SELECT task_id, COUNT(DISTINCT team_id) AS flag_teams FROM flag_submissions GROUP BY task_id) f ON f.task_id = t.task_id
+        LEFT JOIN (SELECT g.task_id, COUNT(*) AS gradings, SUM(g.points = x.max_points) AS full_point_gradings
+            FROM task_grading g JOIN tasks x ON x.task_id = g.task_id
+            WHERE g.deleted_time IS NULL GROUP BY g.task_id) g ON g.task_id = t.task_id
+        LEFT JOIN (SELECT task_id, COUNT(*) AS ratings, SUM(rating) AS rating_sum FROM task_feedback GROUP BY task_id) r ON r.task_id = t.task_id""")
+    return {r["task_id"]: {c: r[c] for c in TASK_STATS_COLUMNS} for r in cur.fetchall()}
+
+def check_task_stats():
+    """Returns a list of (task_id, stored, expected) for all tasks whose counters are off.
+    stored is None if the task has no task_stats row."""
+    cur = get_db().cursor()
+    expected = compute_task_stats(cur)
+    cur.execute("SELECT * FROM task_stats")
+    stored = {r["task_id"]: {c: r[c] for c in TASK_STATS_COLUMNS} for r in cur.fetchall()}
+
+    problems = []
+    for task_id in expected.keys() | stored.keys():
+        exp, st = expected.get(task_id), stored.get(task_id)
+        if exp is None or st is None or any(abs(exp[c] - st[c]) > 1e-6 for c in TASK_STATS_COLUMNS):
+            problems.append((task_id, st, exp))
+    return sorted(problems, key=lambda x: x[0])
+
+def rebuild_task_stats():
+    """Recomputes all counters from the underlying tables."""
+    with transaction() as cur:
+        stats = compute_task_stats(cur)
+        cur.execute("DELETE FROM task_stats")
+        cur.executemany(f"INSERT INTO task_stats (task_id, {', '.join(TASK_STATS_COLUMNS)}) VALUES (?, {', '.join('?' * len(TASK_STATS_COLUMNS))})",
+                [(task_id, *(s[c] for c in TASK_STATS_COLUMNS)) for task_id, s in stats.items()])
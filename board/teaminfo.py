@@ -1,5 +1,6 @@
 from flask import Blueprint, flash, redirect, render_template, request, session, send_file
 from .util import *
+from .scoreboard import rebuild_scoreboard
 
 bp = Blueprint("teaminfo", __name__, url_prefix="/teaminfo")
 
@@ -100,5 +101,7 @@ def team_info_create():
 def team_delete(team_id):
     cur = get_db().cursor()
     cur.execute("UPDATE teams SET deleted = ? WHERE team_id = ?", (int(time.time()), team_id))
+    # Solves of the deleted team no longer count towards the positions of other teams
+    rebuild_scoreboard()
     return redirect("/teaminfo")
 
@@ -1,7 +1,13 @@
+import atexit
 import hashlib
-from functools import wraps
+import itertools
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from functools import wraps, lru_cache
 import sqlite3
 import os
+import queue
 import time
 import re
 from flask import session, g, redirect, flash, current_app, request
@@ -31,73 +37,218 @@ def is_tutor():
     else:
         return False
 
-class BenchmarkingWrapper:
-    def __init__(self, obj, config, id_prefix="", time_add=None):
-        self.obj = obj
-        if len(config) == 3:
-            self.wrap_funcs, self.wrap_objs, self.ignored = config
+DEFAULT_DB_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -32000, # negative: in KiB
+    "mmap_size": 256 * 1024 * 1024,
+}
+
+def connect_db(database, config):
+    db = sqlite3.connect(database, isolation_level=None, check_same_thread=False, cached_statements=config.get("DB_CACHED_STATEMENTS", 256))
+    db.row_factory = sqlite3.Row
+    for pragma, value in config.get("DB_PRAGMAS", DEFAULT_DB_PRAGMAS).items():
+        # Can't prepare PRAGMAs; the values come from the config, not from users
+        db.execute(f"PRAGMA {pragma} = {value}")
+    return db
+
+class ConnectionPool:
+    """Long-lived connections of one worker process, so that SQLite's schema, page and statement
+    caches survive across requests. Connections are handed out to one request (thread) at a time."""
+    def __init__(self, database, config):
+        self.database = database
+        self.config = config
+        self.size = config.get("DB_POOL_SIZE", 4)
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return connect_db(self.database, self.config)
+
+    def release(self, db):
+        # Reset whatever the request left behind
+        if db.in_transaction:
+            db.rollback()
+        db.row_factory = sqlite3.Row
+        if self.idle.qsize() < self.size:
+            self.idle.put(db)
         else:
-            # use length-2 config to not warn about unknown attrs and instead just silently hand them out without changes
-            self.wrap_funcs, self.wrap_objs = config
-            self.ignored = None
-        # urandom instead of simple global counter because gunicorn parallelizes the entire app,
-        # so a simple counter wouldn't be unique, and even hash values possibly would be deterministic
-        self.id = id_prefix + os.urandom(4).hex()
-        self.time = 0
-        self.time_add = time_add or (lambda t: None)
-
-    def __getattr__(self, attrname):
-        attr = getattr(self.obj, attrname)
-
-        subconfig = self.wrap_objs.get(attrname)
-
-        def t(a):
-            self.time += a
-            self.time_add(a)
-
-        if attrname in self.wrap_funcs:
-            def bla(*args, **kwargs):
-                result = self.bm(attr, *args, **kwargs)
-                if subconfig:
-                    return BenchmarkingWrapper(result, subconfig, self.id + "_", t)
-                return result
-            return bla
-
-        if subconfig:
-            return BenchmarkingWrapper(attr, subconfig, self.id + "_", t)
-
-        if self.ignored is not None and attrname not in self.ignored:
-            print(f"BM WARNING: Unknown attr {attrname}; handing out original. Source: {self.id}")
-
-        return attr
-
-    def bm(self, func, *args, **kwargs):
-        start = time.monotonic()
-        result = func(*args, **kwargs)
-        end = time.monotonic()
-        t = end - start
-        self.time += t
-        self.time_add(t)
-        print(f"BM {self.id} {func.__name__:8}: {t:f}, total {self.time:f}{f': {args}' if args else ''}")
-        return result
+            db.close()
 
-    # these two for some reason aren't caught by __getattr__
-    def __iter__(self): return self.__getattr__("__iter__")()
-    def __next__(self): return self.__getattr__("__next__")()
+_pool = None
+# Guards the creation of the per-process pool and write queue, requests may run in threads
+_per_process_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    database = current_app.config["DATABASE"]
+    # Every connection to :memory: is a separate database, so those can't be pooled
+    if database == ":memory:" or current_app.config.get("DB_POOL_SIZE", 4) <= 0:
+        return None
+    with _per_process_lock:
+        # Connections must not be shared with forked gunicorn workers
+        if _pool is None or _pool.database != database or _pool.pid != os.getpid():
+            _pool = ConnectionPool(database, current_app.config)
+        return _pool
+
+class WriteQueue:
+    """Background writer of one worker process. Small writes whose result nobody waits for
+    (activity tracking, logs, counters) are collected for up to DB_WRITE_FLUSH_MS and committed
+    together in one transaction, instead of each taking the SQLite write lock on its own."""
+    def __init__(self, database, config):
+        self.database = database
+        self.config = config
+        self.flush_latency = config.get("DB_WRITE_FLUSH_MS", 50) / 1000
+        self.max_batch = config.get("DB_WRITE_MAX_BATCH", 500)
+        self.pid = os.getpid()
+        self.pending = queue.Queue()
+        # Set once the writer thread died; put() and the dying thread synchronize on lock
+        self.failed = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name="db-write-queue", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def put(self, sql, params):
+        """Returns a Future for the write, or None if the writer thread is dead and the caller has
+        to execute the write itself."""
+        with self.lock:
+            if self.failed or not self.thread.is_alive():
+                return None
+            future = Future()
+            self.pending.put((sql, params, future))
+        return future
+
+    def close(self):
+        """Flushes all pending writes and stops the writer thread."""
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+
+    def run(self):
+        batch = []
+        try:
+            db = connect_db(self.database, self.config)
+            while True:
+                batch = [self.pending.get()]
+                deadline = time.monotonic() + self.flush_latency
+                while len(batch) < self.max_batch and batch[-1] is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.pending.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                stop = batch[-1] is None
+                self.commit(db, [b for b in batch if b is not None])
+                if stop:
+                    db.close()
+                    return
+        except Exception as e:
+            # E.g. the database can't be opened or a rollback failed. Later writes are executed
+            # directly by queue_write(), the ones already queued are failed.
+            print(f"Write queue stopped: {e!r}")
+            with self.lock:
+                self.failed = True
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                if item is not None and not item[2].done():
+                    item[2].set_exception(e)
+
+    def commit(self, db, batch):
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            # Consecutive writes of the same statement are sent as one executemany
+            for sql, group in itertools.groupby(batch, key=lambda b: b[0]):
+                db.executemany(sql, [params for _, params, _ in group])
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            if db.in_transaction:
+                db.rollback()
+            # Retry one by one so that a single bad statement doesn't take the others down with it
+            for sql, params, future in batch:
+                try:
+                    db.execute(sql, params)
+                except sqlite3.Error as e:
+                    print(f"Queued write failed: {e}; {sql} {params}")
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+            return
+        for _, _, future in batch:
+            future.set_result(None)
+
+_write_queue = None
+
+def get_write_queue():
+    global _write_queue
+    database = current_app.config["DATABASE"]
+    # A separate writer connection would not see an in-memory database
+    if database == ":memory:" or not current_app.config.get("DB_WRITE_QUEUE", True):
+        return None
+    with _per_process_lock:
+        if _write_queue is None or _write_queue.database != database or _write_queue.pid != os.getpid():
+            _write_queue = WriteQueue(database, current_app.config)
+        return _write_queue
+
+def queue_write(sql, params=()):
+    """Executes a write asynchronously through the worker's write queue and returns a Future
+    that completes once it is committed. Writes may become visible only after the current
+    request, so only use this where nothing reads the result back right away. Don't wait for the
+    Future while holding a transaction yourself, since the writer needs the write lock."""
+    wq = get_write_queue()
+    future = wq.put(sql, params) if wq else None
+    if future is None:
+        get_db().execute(sql, params)
+        future = Future()
+        future.set_result(None)
+    return future
 
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = sqlite3.connect(current_app.config["DATABASE"], isolation_level=None)
-        db.row_factory = sqlite3.Row
-        if current_app.config.get("BENCHMARK_DB"):
-            import time
-            bm_conf_cursor = (["execute", "fetchall", "fetchone", "__iter__"], {"__iter__": (["__next__"], {}, []), "execute": ([], {}, [])}, [])
-            bm_conf_db = (["execute", "cursor", "close"], {"cursor": bm_conf_cursor, "execute": bm_conf_cursor}, [])
-            db = BenchmarkingWrapper(db, bm_conf_db)
+        pool = get_pool()
+        db = pool.acquire() if pool else connect_db(current_app.config["DATABASE"], current_app.config)
         g._database = db
+    # Set by the query profiler for sampled requests (see board/profiler.py)
+    profile = getattr(g, '_db_profile', None)
+    if profile is not None:
+        return profile.wrap(db)
     return db
 
+def release_db():
+    """Hands the request's connection back to the pool (or closes it if pooling is off)."""
+    db = g.pop('_database', None)
+    if db is None:
+        return
+    pool = get_pool()
+    if pool:
+        pool.release(db)
+    else:
+        db.close()
+
+@contextmanager
+def transaction():
+    """Runs the enclosed statements in a single write transaction.
+    Connections are in autocommit mode otherwise, so each statement would commit on its own."""
+    db = get_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db.cursor()
+    except:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
 def get_team_from_db():
     return user_to_team(session['user-id'])
 
@@ -237,48 +388,122 @@ def create_flag_key(task_id):
     key = struct.pack('>H', task_id) + os.urandom(32)
     return key
 
+@lru_cache
+def flag_regex(prefix):
+    return re.compile(prefix + FLAG_BODY_REGEX)
+
 def find_flags(text):
-    for m in re.finditer(current_app.config["FLAG_PREFIX"] + FLAG_BODY_REGEX, text):
+    for m in flag_regex(current_app.config["FLAG_PREFIX"]).finditer(text):
         yield m.group(0)
 
+# Per-process cache of the task data needed to verify flags: task_id -> dict with the task's
+# flag key, task_short, from_date and a prepared cipher. Edits in this process invalidate entries
+# directly; edits in other gunicorn workers are picked up once FLAG_KEY_CACHE_SECONDS have passed.
+_task_key_cache = {}
+
+def invalidate_task_key_cache(task_id=None):
+    if task_id is None:
+        _task_key_cache.clear()
+    else:
+        _task_key_cache.pop(task_id, None)
+
+def get_task_key_infos(task_ids):
+    """Returns a dict task_id -> cache entry for all of the given tasks that exist and have a flag key."""
+    now = time.monotonic()
+    max_age = current_app.config.get("FLAG_KEY_CACHE_SECONDS", 60)
+    result = {}
+    missing = []
+    for task_id in set(task_ids):
+        entry = _task_key_cache.get(task_id)
+        if entry and now - entry["loaded"] < max_age:
+            result[task_id] = entry
+        else:
+            _task_key_cache.pop(task_id, None)
+            missing.append(task_id)
+    if not missing:
+        return result
+
+    cur = get_db().cursor()
+    cur.execute(f"SELECT task_id, flag_key, task_short, from_date FROM tasks WHERE task_id IN ({','.join('?' * len(missing))})", missing)
+    for r in cur.fetchall():
+        if not r["flag_key"]:
+            continue
+        key_task_id, cipher_key = struct.unpack(">H32s", r["flag_key"])
+        entry = {
+            "flag_key": r["flag_key"],
+            "key_task_id": key_task_id,
+            "task_short": r["task_short"],
+            "from_date": r["from_date"],
+            # ECB has no state between calls, so the cipher object can be reused
+            "cipher": AES.new(key=cipher_key, mode=AES.MODE_ECB),
+            "loaded": now,
+        }
+        _task_key_cache[r["task_id"]] = entry
+        result[r["task_id"]] = entry
+    return result
+
+def get_task_key_info(task_id):
+    return get_task_key_infos([task_id]).get(task_id)
+
 def check_flag(flag):
     result, _ = check_flag_details(flag)
     return result
 
 def check_flag_details(flag):
-    m = re.match(current_app.config["FLAG_PREFIX"] + FLAG_BODY_REGEX, flag)
-    if not m:
-        return None, f"Not a flag: doesn't match flag regex"
-    raw = bytes.fromhex(m.group(1))
-    data, checksum = raw[:-2], raw[-2:]
-    for start in range(0, len(data), 2):
-        checksum = bytes(a ^ b for a, b in zip(checksum, data[start:start + 2]))
-    task_id = struct.unpack(">H", checksum)[0]
-    key = get_flag_key(task_id)
-    if not key:
-        return None, f"taskid {task_id}, but no key found (probably flag commpletely broken / task doesn't exist)"
-    key_task_id, cipher_key = struct.unpack(">H32s", key)
-    if key_task_id != task_id:
-        return None, f"taskid {task_id}, but key's taskid doesn't match!? Database is inconsistent!"
-    ci = AES.new(key=cipher_key, mode=AES.MODE_ECB)
-    dflag = ci.decrypt(data)
+    return check_flags_bulk([flag])[flag]
+
+def _decode_flag(task_id, info, dflag):
     ftime, stored_task_id, pad = struct.unpack(">QH6s", dflag)
     if pad != b"\0" * 6 or stored_task_id != task_id:
         return None, f"taskid {task_id}; decryption result nonsensical: ftime {ftime}, stored_taskid {stored_task_id}, pad {pad}"
 
-    cur = get_db().cursor()
-    cur.execute("SELECT task_short FROM tasks WHERE task_id=?", (task_id,))
-    r = cur.fetchone()
-    if not r:
-        return None, "taskid {task_id}; key found and decryption sensible, but no task in db!? Database is inconsistent!"
-    task_short = r["task_short"]
+    task_short = info["task_short"]
 
     if current_app.config["FLAG_VALID_START"]*1e6 < ftime <= current_app.config["FLAG_VALID_END"]*1e6:
-        return {"task_id": task_id, "task_short": task_short, "ftime": ftime}, "Valid flag according to all metrics"
+        return {"task_id": task_id, "task_short": task_short, "from_date": info["from_date"], "ftime": ftime}, "Valid flag according to all metrics"
     t = time.localtime(ftime / 1e6)
     tstr = time.strftime('%Y-%m-%d %H:%M:%S', t)
     return None, f"taskid {task_id} / {task_short}; pad and taskid valid, but ftime nonsensical / out of bounds: {ftime} / {tstr}"
 
+_FLAG_WORDS = struct.Struct(">9H")
+
+def check_flags_bulk(flags):
+    """Verifies many flags at once. Duplicates are checked only once, and all flags of the
+    same task are decrypted with a single cipher call.
+    Returns a dict mapping every distinct flag to the (result, details) pair that
+    check_flag_details would return for it."""
+    results = {}
+    by_task = {}
+    regex = flag_regex(current_app.config["FLAG_PREFIX"])
+    for flag in dict.fromkeys(flags):
+        m = regex.match(flag)
+        if not m:
+            results[flag] = (None, f"Not a flag: doesn't match flag regex")
+            continue
+        raw = bytes.fromhex(m.group(1))
+        # The checksum is the XOR of all 16 bit words of the encrypted data and the task id,
+        # so XORing all nine words of the flag body yields the task id.
+        a, b, c, d, e, f, g, h, i = _FLAG_WORDS.unpack(raw)
+        task_id = a ^ b ^ c ^ d ^ e ^ f ^ g ^ h ^ i
+        by_task.setdefault(task_id, []).append((flag, raw[:-2]))
+
+    infos = get_task_key_infos(by_task.keys())
+    for task_id, group in by_task.items():
+        info = infos.get(task_id)
+        if not info:
+            error = (None, f"taskid {task_id}, but no key found (probably flag commpletely broken / task doesn't exist)")
+        elif info["key_task_id"] != task_id:
+            error = (None, f"taskid {task_id}, but key's taskid doesn't match!? Database is inconsistent!")
+        else:
+            # Every flag body is exactly one AES block, so the whole group can be decrypted at once
+            decrypted = info["cipher"].decrypt(b"".join(data for _, data in group))
+            for i, (flag, _) in enumerate(group):
+                results[flag] = _decode_flag(task_id, info, decrypted[16 * i:16 * (i + 1)])
+            continue
+        for flag, _ in group:
+            results[flag] = error
+    return results
+
 def generate_flag(task_id, time, flag_key):
     key_task_id, cipher_key = struct.unpack(">H32s", flag_key)
     if key_task_id != task_id:
@@ -347,14 +572,21 @@ def add_user(email, firstname, name, matrikel, pw):
     cur.execute("INSERT INTO users (vorname, nachname, email, password, matrikel, role,displayname) VALUES (?,?,?,?,?,0,?)", (firstname, name, email, db_pw, matrikel, f"{firstname} {name}"))
 
 def set_task_status(task_id, ok):
+    set_tasks_status([task_id], ok)
+
+def set_tasks_status(task_ids, ok):
+    task_ids = list(set(task_ids))
+    if not task_ids:
+        return
+    placeholders = ",".join("?" * len(task_ids))
     cur = get_db().cursor()
-    cur.execute("SELECT status FROM tasks WHERE task_id=?", (task_id,))
-    r = cur.fetchone()
-    old_status = r['status']
-    if old_status != ok:
-        log_event(None, "task_status", f"Task {task_id} changed status from {old_status} to {ok}")
+    cur.execute(f"SELECT task_id, status FROM tasks WHERE task_id IN ({placeholders})", task_ids)
+    for r in cur.fetchall():
+        old_status = r['status']
+        if old_status != ok:
+            log_event(None, "task_status", f"Task {r['task_id']} changed status from {old_status} to {ok}")
 
-    cur.execute("UPDATE tasks SET last_check_time=strftime('%s','now'), status=? WHERE task_id=?", (ok, task_id))
+    cur.execute(f"UPDATE tasks SET last_check_time=strftime('%s','now'), status=? WHERE task_id IN ({placeholders})", [ok] + task_ids)
 
 def get_comments(task_id, team_id):
     comments = []
@@ -404,5 +636,16 @@ class Category(enum.Enum):
 def log_event(user_id, category, message):
     if isinstance(category, Category):
         category = category.value
-    cur = get_db().cursor()
-    cur.execute("INSERT INTO logs (time, user_id, category, message) VALUES (strftime('%s','now'),?,?,?)", (user_id, category, message))
+    queue_write("INSERT INTO logs (time, user_id, category, message) VALUES (strftime('%s','now'),?,?,?)", (user_id, category, message))
+
+# Per-worker time of the last last_active write for each user
+_activity_written = {}
+
+def record_activity(user_id):
+    """Updates users.last_active at most once per ACTIVITY_LOG_INTERVAL seconds per user and worker.
+    The updates go through the write queue, which coalesces those of concurrent users into one executemany."""
+    now = int(time.time())
+    if now - _activity_written.get(user_id, 0) < current_app.config.get("ACTIVITY_LOG_INTERVAL", 60):
+        return
+    _activity_written[user_id] = now
+    queue_write("UPDATE users SET last_active = ? WHERE id = ?", (now, user_id))
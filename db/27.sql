@@ -0,0 +1,22 @@
+BEGIN EXCLUSIVE;
+	/* Materialized scoreboard: first solve of every (team, task) and its position among all solves of that task */
+	CREATE TABLE scoreboard_solves
+	(
+		team_id INTEGER NOT NULL REFERENCES teams(team_id),
+		task_id INTEGER NOT NULL REFERENCES tasks(task_id),
+		flag_time INTEGER NOT NULL,
+		position INTEGER NOT NULL,
+		PRIMARY KEY(team_id, task_id)
+	);
+	CREATE INDEX scoreboard_solves_by_task ON scoreboard_solves (task_id, flag_time);
+
+	INSERT INTO scoreboard_solves (team_id, task_id, flag_time, position)
+	SELECT team_id, task_id, flag_time, ROW_NUMBER() OVER (PARTITION BY task_id ORDER BY flag_time, first_rowid)
+	FROM (
+		SELECT s.team_id, s.task_id, MIN(s.flag_time) AS flag_time, MIN(s.rowid) AS first_rowid
+		FROM flag_submissions s
+		LEFT JOIN teams t ON s.team_id = t.team_id
+		WHERE t.deleted IS NULL
+		GROUP BY s.team_id, s.task_id
+	);
+COMMIT;
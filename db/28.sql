@@ -0,0 +1,13 @@
+BEGIN EXCLUSIVE;
+	/* Computed scoreboard shared between all workers; recomputed whenever version moves past snapshot_version */
+	CREATE TABLE scoreboard_cache
+	(
+		id INTEGER PRIMARY KEY CHECK (id = 1),
+		version INTEGER NOT NULL,
+		snapshot_version INTEGER,
+		snapshot_id TEXT,
+		valid_until INTEGER,
+		snapshot TEXT
+	);
+	INSERT INTO scoreboard_cache (id, version) VALUES (1, 1);
+COMMIT;
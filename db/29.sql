@@ -0,0 +1,20 @@
+BEGIN EXCLUSIVE;
+	/* Indexes for the hot lookup paths; check with "python3 app.py check-query-plans" */
+	CREATE INDEX flag_submissions_by_flag ON flag_submissions (flag);
+	CREATE INDEX flag_submissions_by_task ON flag_submissions (task_id, team_id);
+	CREATE INDEX flag_submissions_by_team ON flag_submissions (team_id, task_id, flag_time);
+	CREATE INDEX team_members_by_member ON team_members (member_id, team_id);
+	CREATE INDEX team_members_by_team ON team_members (team_id, member_id);
+	CREATE INDEX task_submissions_by_task_team ON task_submissions (task_id, team_id, submission_time);
+	/* (task_id, team_id, deleted_time) is already covered by the UNIQUE constraint */
+	CREATE INDEX task_grading_by_team ON task_grading (team_id, task_id, deleted_time);
+	CREATE INDEX submission_comments_by_task_team ON submission_comments (task_id, team_id, created_time);
+	CREATE INDEX booking_requests_by_user ON booking_requests (user_id, confirmed);
+	CREATE INDEX tutorium_attendance_students_by_user ON tutorium_attendance_students (user_id);
+	CREATE INDEX users_by_permanent_id ON users (permanent_id);
+	CREATE INDEX users_by_email ON users (email);
+	CREATE INDEX teams_by_teamname ON teams (teamname);
+	CREATE INDEX sshkeys_by_user ON sshkeys (user_id);
+	CREATE INDEX timesheet_records_by_user ON timesheet_records (user_id, start);
+	ANALYZE;
+COMMIT;
@@ -0,0 +1,115 @@
+BEGIN EXCLUSIVE;
+	/* Per-task statistics for the task admin overview, kept up to date by the triggers below.
+	   Check and repair with "python3 app.py check-task-stats [--fix]" */
+	CREATE TABLE task_stats
+	(
+		task_id INTEGER PRIMARY KEY REFERENCES tasks(task_id),
+		submission_teams INTEGER NOT NULL DEFAULT 0, /* distinct teams with a file submission */
+		flag_teams INTEGER NOT NULL DEFAULT 0, /* distinct teams with a flag submission */
+		gradings INTEGER NOT NULL DEFAULT 0, /* non-deleted gradings */
+		full_point_gradings INTEGER NOT NULL DEFAULT 0, /* non-deleted gradings with points = max_points */
+		ratings INTEGER NOT NULL DEFAULT 0,
+		rating_sum REAL NOT NULL DEFAULT 0
+	);
+
+	INSERT INTO task_stats (task_id, submission_teams, flag_teams, gradings, full_point_gradings, ratings, rating_sum)
+	SELECT t.task_id,
+		(SELECT COUNT(DISTINCT team_id) FROM task_submissions WHERE task_id = t.task_id),
+		(SELECT COUNT(DISTINCT team_id) FROM flag_submissions WHERE task_id = t.task_id),
+		(SELECT COUNT(*) FROM task_grading WHERE task_id = t.task_id AND deleted_time IS NULL),
+		(SELECT COUNT(*) FROM task_grading WHERE task_id = t.task_id AND deleted_time IS NULL AND points = t.max_points),
+		(SELECT COUNT(*) FROM task_feedback WHERE task_id = t.task_id),
+		(SELECT COALESCE(SUM(rating), 0) FROM task_feedback WHERE task_id = t.task_id)
+	FROM tasks t;
+
+	CREATE TRIGGER task_stats_task_insert AFTER INSERT ON tasks
+	BEGIN
+		INSERT OR IGNORE INTO task_stats (task_id) VALUES (NEW.task_id);
+	END;
+
+	CREATE TRIGGER task_stats_task_delete AFTER DELETE ON tasks
+	BEGIN
+		DELETE FROM task_stats WHERE task_id = OLD.task_id;
+	END;
+
+	CREATE TRIGGER task_stats_task_max_points AFTER UPDATE OF max_points ON tasks
+	BEGIN
+		UPDATE task_stats SET full_point_gradings =
+			(SELECT COUNT(*) FROM task_grading WHERE task_id = NEW.task_id AND deleted_time IS NULL AND points = NEW.max_points)
+		WHERE task_id = NEW.task_id;
+	END;
+
+	/* A team only counts once per task, so only its first submission/flag and the removal of its last one matter */
+	CREATE TRIGGER task_stats_submission_insert AFTER INSERT ON task_submissions
+	WHEN NOT EXISTS (SELECT 1 FROM task_submissions WHERE task_id = NEW.task_id AND team_id = NEW.team_id AND id != NEW.id)
+	BEGIN
+		INSERT INTO task_stats (task_id, submission_teams) VALUES (NEW.task_id, 1)
+			ON CONFLICT (task_id) DO UPDATE SET submission_teams = submission_teams + 1;
+	END;
+
+	CREATE TRIGGER task_stats_submission_delete AFTER DELETE ON task_submissions
+	WHEN NOT EXISTS (SELECT 1 FROM task_submissions WHERE task_id = OLD.task_id AND team_id = OLD.team_id)
+	BEGIN
+		UPDATE task_stats SET submission_teams = submission_teams - 1 WHERE task_id = OLD.task_id;
+	END;
+
+	CREATE TRIGGER task_stats_flag_insert AFTER INSERT ON flag_submissions
+	WHEN NOT EXISTS (SELECT 1 FROM flag_submissions WHERE task_id = NEW.task_id AND team_id = NEW.team_id AND rowid != NEW.rowid)
+	BEGIN
+		INSERT INTO task_stats (task_id, flag_teams) VALUES (NEW.task_id, 1)
+			ON CONFLICT (task_id) DO UPDATE SET flag_teams = flag_teams + 1;
+	END;
+
+	CREATE TRIGGER task_stats_flag_delete AFTER DELETE ON flag_submissions
+	WHEN NOT EXISTS (SELECT 1 FROM flag_submissions WHERE task_id = OLD.task_id AND team_id = OLD.team_id)
+	BEGIN
+		UPDATE task_stats SET flag_teams = flag_teams - 1 WHERE task_id = OLD.task_id;
+	END;
+
+	/* Gradings are never updated in place except for being marked as deleted, but handle points changes anyway */
+	CREATE TRIGGER task_stats_grading_insert AFTER INSERT ON task_grading
+	WHEN NEW.deleted_time IS NULL
+	BEGIN
+		INSERT INTO task_stats (task_id, gradings, full_point_gradings)
+			VALUES (NEW.task_id, 1, NEW.points = (SELECT max_points FROM tasks WHERE task_id = NEW.task_id))
+			ON CONFLICT (task_id) DO UPDATE SET gradings = gradings + 1, full_point_gradings = full_point_gradings + excluded.full_point_gradings;
+	END;
+
+	CREATE TRIGGER task_stats_grading_update AFTER UPDATE OF task_id, points, deleted_time ON task_grading
+	BEGIN
+		UPDATE task_stats SET
+			gradings = gradings - (OLD.deleted_time IS NULL),
+			full_point_gradings = full_point_gradings - (OLD.deleted_time IS NULL AND OLD.points = (SELECT max_points FROM tasks WHERE task_id = OLD.task_id))
+		WHERE task_id = OLD.task_id;
+		UPDATE task_stats SET
+			gradings = gradings + (NEW.deleted_time IS NULL),
+			full_point_gradings = full_point_gradings + (NEW.deleted_time IS NULL AND NEW.points = (SELECT max_points FROM tasks WHERE task_id = NEW.task_id))
+		WHERE task_id = NEW.task_id;
+	END;
+
+	CREATE TRIGGER task_stats_grading_delete AFTER DELETE ON task_grading
+	WHEN OLD.deleted_time IS NULL
+	BEGIN
+		UPDATE task_stats SET
+			gradings = gradings - 1,
+			full_point_gradings = full_point_gradings - (OLD.points = (SELECT max_points FROM tasks WHERE task_id = OLD.task_id))
+		WHERE task_id = OLD.task_id;
+	END;
+
+	CREATE TRIGGER task_stats_feedback_insert AFTER INSERT ON task_feedback
+	BEGIN
+		INSERT INTO task_stats (task_id, ratings, rating_sum) VALUES (NEW.task_id, 1, NEW.rating)
+			ON CONFLICT (task_id) DO UPDATE SET ratings = ratings + 1, rating_sum = rating_sum + NEW.rating;
+	END;
+
+	CREATE TRIGGER task_stats_feedback_update AFTER UPDATE OF task_id, rating ON task_feedback
+	BEGIN
+		UPDATE task_stats SET ratings = ratings - 1, rating_sum = rating_sum - OLD.rating WHERE task_id = OLD.task_id;
+		UPDATE task_stats SET ratings = ratings + 1, rating_sum = rating_sum + NEW.rating WHERE task_id = NEW.task_id;
+	END;
+
+	CREATE TRIGGER task_stats_feedback_delete AFTER DELETE ON task_feedback
+	BEGIN
+		UPDATE task_stats SET ratings = ratings - 1, rating_sum = rating_sum - OLD.rating WHERE task_id = OLD.task_id;
+	END;
+COMMIT;
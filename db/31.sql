@@ -0,0 +1,10 @@
+BEGIN EXCLUSIVE;
+	/* Grade imports staged between the diff preview and the import, referenced by an opaque id */
+	CREATE TABLE grade_changesets
+	(
+		id TEXT PRIMARY KEY,
+		user_id INTEGER NOT NULL REFERENCES users(id),
+		created_time INTEGER NOT NULL,
+		changeset TEXT NOT NULL /* JSON list of ("n"|"m", new grade, old grade) */
+	);
+COMMIT;
@@ -0,0 +1,5 @@
+BEGIN EXCLUSIVE;
+	/* Submissions are stored as submissions/blobs/<xx>/<sha256>; NULL for files not yet moved there by
+	   "python3 app.py migrate-submissions" */
+	ALTER TABLE task_submissions ADD COLUMN sha256 TEXT;
+COMMIT;
@@ -0,0 +1,10 @@
+BEGIN EXCLUSIVE;
+	/* Autograding jobs claimed by a grader instance (POST /autograde/claim). A lease that isn't renewed by a
+	   heartbeat before it expires is ignored, so the submission is handed out again. */
+	CREATE TABLE autograde_leases
+	(
+		submission_id INTEGER PRIMARY KEY REFERENCES task_submissions(id),
+		holder TEXT NOT NULL,
+		expires INTEGER NOT NULL
+	);
+COMMIT;
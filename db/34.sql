@@ -0,0 +1,67 @@
+BEGIN EXCLUSIVE;
+	/* Autograding queue: the latest ungraded submission per team and autograded task, kept up to date by the
+	   triggers below. Submissions superseded while waiting are marked CANCELED (autograde_result 5). */
+	CREATE TABLE autograde_queue
+	(
+		task_id INTEGER NOT NULL REFERENCES tasks(task_id),
+		team_id INTEGER NOT NULL,
+		submission_id INTEGER NOT NULL UNIQUE REFERENCES task_submissions(id),
+		PRIMARY KEY (task_id, team_id)
+	);
+
+	UPDATE task_submissions SET autograde_result = 5, autograde_output = '<overridden by later submission>'
+	WHERE autograde_result IS NULL
+		AND task_id IN (SELECT task_id FROM tasks WHERE autograded = 1)
+		AND EXISTS (SELECT 1 FROM task_submissions sb WHERE sb.task_id = task_submissions.task_id AND sb.team_id = task_submissions.team_id
+			AND (sb.submission_time, sb.id) > (task_submissions.submission_time, task_submissions.id));
+
+	INSERT INTO autograde_queue (task_id, team_id, submission_id)
+	SELECT s.task_id, s.team_id, s.id
+	FROM task_submissions s JOIN tasks t ON t.task_id = s.task_id
+	WHERE t.autograded = 1 AND s.autograde_result IS NULL;
+
+	CREATE TRIGGER autograde_queue_submission_insert AFTER INSERT ON task_submissions
+	WHEN NEW.autograde_result IS NULL AND (SELECT autograded FROM tasks WHERE task_id = NEW.task_id) = 1
+	BEGIN
+		UPDATE task_submissions SET autograde_result = 5, autograde_output = '<overridden by later submission>'
+		WHERE id = (SELECT submission_id FROM autograde_queue WHERE task_id = NEW.task_id AND team_id = NEW.team_id);
+		DELETE FROM autograde_leases WHERE submission_id = (SELECT submission_id FROM autograde_queue WHERE task_id = NEW.task_id AND team_id = NEW.team_id);
+		INSERT INTO autograde_queue (task_id, team_id, submission_id) VALUES (NEW.task_id, NEW.team_id, NEW.id)
+			ON CONFLICT (task_id, team_id) DO UPDATE SET submission_id = excluded.submission_id;
+	END;
+
+	/* Consumed when the result arrives (or the submission is canceled) */
+	CREATE TRIGGER autograde_queue_submission_result AFTER UPDATE OF autograde_result ON task_submissions
+	WHEN NEW.autograde_result IS NOT NULL
+	BEGIN
+		DELETE FROM autograde_queue WHERE submission_id = NEW.id;
+	END;
+
+	CREATE TRIGGER autograde_queue_submission_delete AFTER DELETE ON task_submissions
+	BEGIN
+		DELETE FROM autograde_queue WHERE submission_id = OLD.id;
+		DELETE FROM autograde_leases WHERE submission_id = OLD.id;
+	END;
+
+	/* Enabling autograding for a task queues the latest ungraded submission of every team */
+	CREATE TRIGGER autograde_queue_task_enable AFTER UPDATE OF autograded ON tasks
+	WHEN NEW.autograded = 1 AND OLD.autograded IS NOT 1
+	BEGIN
+		INSERT OR IGNORE INTO autograde_queue (task_id, team_id, submission_id)
+		SELECT s.task_id, s.team_id, s.id FROM task_submissions s
+		WHERE s.task_id = NEW.task_id AND s.autograde_result IS NULL
+			AND NOT EXISTS (SELECT 1 FROM task_submissions sb WHERE sb.task_id = s.task_id AND sb.team_id = s.team_id
+				AND (sb.submission_time, sb.id) > (s.submission_time, s.id));
+	END;
+
+	CREATE TRIGGER autograde_queue_task_disable AFTER UPDATE OF autograded ON tasks
+	WHEN NEW.autograded IS NOT 1
+	BEGIN
+		DELETE FROM autograde_queue WHERE task_id = NEW.task_id;
+	END;
+
+	CREATE TRIGGER autograde_queue_task_delete AFTER DELETE ON tasks
+	BEGIN
+		DELETE FROM autograde_queue WHERE task_id = OLD.task_id;
+	END;
+COMMIT;
@@ -2,12 +2,23 @@ import unittest
 import app
 import contextlib
 import flask
+import click.testing
 import time
 import io
 import re
 import secrets
 import tempfile
+import zipfile
+import threading
+import os
 import board.util
+import board.queryplans
+import board.profiler
+import board.taskadmin
+import board.taskstats
+import board.gradeupload
+import board.submissions
+import board.autograde
 
 samplecsv = b"""team;task;points;comment;internal_comment;corrector
 1;0;0.5;Test;Test;Fabian
@@ -31,6 +42,7 @@ class TestScoreboard(unittest.TestCase):
             self.addCleanup(stack.pop_all().close)
 
         app.init_db()
+        board.util.invalidate_task_key_cache()
         app.add_user("testa","testa","testa", None, "testa")
         app.add_user("testb","testb","testb", None, "testb")
         app.add_user("testc","testc","testc", None, "testc")
@@ -96,6 +108,90 @@ class TestScoreboard(unittest.TestCase):
             rv = client.post("/flag", data={"flag": self.testflag}, follow_redirects=True)
             self.assertIn(b"Looks like a flag", rv.data)
 
+    def test_scoreboard_positions(self):
+        flag_key = app.get_db().execute("SELECT flag_key FROM tasks WHERE task_id = 1").fetchone()[0]
+        start = int(app.app.config["FLAG_VALID_START"]*1e6)
+        app.create_team([1, 2])
+        with app.app.test_client() as client:
+            self.log_me_in(client, "testc", "testc")
+            client.post("/flag", data={"flag": board.util.generate_flag(1, start + 2000, flag_key)})
+            self.logout(client)
+            self.log_me_in(client, "testa", "testa")
+            # Older flag submitted later still ranks first
+            client.post("/flag", data={"flag": board.util.generate_flag(1, start + 1000, flag_key)})
+            client.post("/flag", data={"flag": board.util.generate_flag(1, start + 3000, flag_key)})
+
+        query = "SELECT team_id, task_id, position FROM scoreboard_solves ORDER BY team_id"
+        incremental = [tuple(r) for r in app.get_db().execute(query)]
+        self.assertEqual(incremental, [(1, 1, 2), (2, 1, 1)])
+        app.rebuild_scoreboard()
+        self.assertEqual([tuple(r) for r in app.get_db().execute(query)], incremental)
+
+    def test_scoreboard_cache_invalidation(self):
+        with app.app.test_client() as client:
+            self.log_me_in(client, "testc", "testc")
+            rv = client.post("/flag", data={"flag": self.testflag}, follow_redirects=True)
+            self.assertIn(b"Team 1", rv.data)
+            client.post("/team/changename", data={"teamname": "foobar"})
+            rv = client.get("/scoreboard")
+            self.assertIn(b"foobar", rv.data)
+            self.assertNotIn(b"Team 1", rv.data)
+
+    def test_scoreboard_etag(self):
+        with app.app.test_client() as client:
+            self.log_me_in(client, "testc", "testc")
+            rv = client.get("/scoreboard")
+            self.assertEqual(rv.status_code, 200)
+            etag = rv.headers["ETag"]
+            rv = client.get("/scoreboard", headers={"If-None-Match": etag})
+            self.assertEqual(rv.status_code, 304)
+
+            rv = client.get("/scoreboard.json")
+            json_etag = rv.headers["ETag"]
+            self.assertEqual(rv.get_json()["scoreboard"], [])
+            client.post("/flag", data={"flag": self.testflag})
+            rv = client.get("/scoreboard.json", headers={"If-None-Match": json_etag})
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.get_json()["scoreboard"][0]["solves"], {"1": 1})
+            # The flash message is pending, so the page must not be served from cache
+            rv = client.get("/scoreboard", headers={"If-None-Match": etag})
+            self.assertEqual(rv.status_code, 200)
+
+    def test_activity_throttled(self):
+        board.util._activity_written.clear()
+        with app.app.test_client() as client:
+            self.log_me_in(client, "testa", "testa")
+            cur = app.get_db().cursor()
+            first = cur.execute("SELECT last_active FROM users WHERE id = 1").fetchone()[0]
+            self.assertIsNotNone(first)
+            cur.execute("UPDATE users SET last_active = 0 WHERE id = 1")
+            client.get("/scoreboard")
+            self.assertEqual(cur.execute("SELECT last_active FROM users WHERE id = 1").fetchone()[0], 0)
+
+    def test_write_queue(self):
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        database = os.path.join(d.name, "test.db")
+        db = board.util.connect_db(database, app.app.config)
+        self.addCleanup(db.close)
+        db.execute("CREATE TABLE t (x INTEGER NOT NULL)")
+
+        # Long enough that all writes end up in the same batch
+        wq = board.util.WriteQueue(database, {**app.app.config, "DB_WRITE_FLUSH_MS": 1000})
+        futures = [wq.put("INSERT INTO t VALUES (?)", (i,)) for i in range(3)]
+        bad = wq.put("INSERT INTO t VALUES (?)", (None,))
+        futures += [wq.put("UPDATE t SET x = x + 10 WHERE x = ?", (i,)) for i in range(2)]
+        wq.close()
+        self.assertIsInstance(bad.exception(timeout=0), board.util.sqlite3.IntegrityError)
+        for f in futures:
+            self.assertIsNone(f.result(timeout=0))
+        self.assertEqual([r[0] for r in db.execute("SELECT x FROM t ORDER BY x")], [2, 10, 11])
+
+        # Writes aren't lost if the writer thread dies
+        wq = board.util.WriteQueue(os.path.join(d.name, "missing", "test.db"), app.app.config)
+        wq.thread.join()
+        self.assertIsNone(wq.put("INSERT INTO t VALUES (?)", (1,)))
+
     def test_upload_solution(self):
         with app.app.test_client() as client:
             rv = self.log_me_in(client, "testd", "testd")
@@ -145,6 +241,399 @@ class TestScoreboard(unittest.TestCase):
             rv = client.get("/sshkeys")
             self.assertEqual(rv.status_code, 200)
 
+    def test_check_flags_bulk(self):
+        flag_key = app.get_db().execute("SELECT flag_key FROM tasks WHERE task_id = 1").fetchone()[0]
+        other = board.util.generate_flag(1, int(app.app.config["FLAG_VALID_START"]*1e6 + 2000), flag_key)
+        results = board.util.check_flags_bulk([self.testflag, "flag{foobar}", other, self.testflag])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[self.testflag][0]["task_id"], 1)
+        self.assertEqual(results[other][0]["ftime"], int(app.app.config["FLAG_VALID_START"]*1e6 + 2000))
+        self.assertIsNone(results["flag{foobar}"][0])
+        self.assertEqual(board.util.check_flag_details(self.testflag), results[self.testflag])
+
+    def test_validate_flags(self):
+        with app.app.test_client() as client:
+            self.log_me_in(client, "testc", "testc")
+            client.post("/flag", data={"flag": self.testflag})
+        prefix = app.app.config["FLAG_PREFIX"] + "{"
+        body = bytearray.fromhex(self.testflag[len(prefix):-1])
+        # A wrong checksum points to a task that doesn't exist
+        wrong_task = bytes(body[:-1]) + bytes([body[-1] ^ 1])
+        # Flipping the same bit in the ciphertext and the checksum keeps the task id, but decrypts to garbage
+        body[0] ^= 1
+        body[-2] ^= 1
+        garbage = bytes(body)
+        corrupted = [prefix + raw.hex() + "}" for raw in (wrong_task, garbage)]
+        for flag in corrupted:
+            app.get_db().execute("INSERT INTO flag_submissions (flag, team_id, user_id, task_id, submission_time, flag_time) VALUES (?, 1, 3, 1, strftime('%s','now'), 0)", (flag,))
+        rv = click.testing.CliRunner().invoke(app.validate_flags, ["--batch-size", "2"])
+        self.assertEqual(rv.exit_code, 0, rv.output)
+        self.assertIn(f"flag {corrupted[0]}): invalid", rv.output)
+        self.assertIn(f"flag {corrupted[1]}): invalid: taskid 1; decryption result nonsensical", rv.output)
+        self.assertNotIn(self.testflag, rv.output)
+        self.assertIn("Checked 3 flags", rv.output)
+        self.assertIn("2 problematic", rv.output)
+
+    def test_hot_queries_use_indexes(self):
+        db = board.queryplans.create_schema()
+        for sql in [
+            "SELECT user_id, team_id FROM flag_submissions WHERE flag=?",
+            "SELECT * FROM team_members tm LEFT JOIN teams t ON t.team_id = tm.team_id WHERE member_id = ? and t.deleted is null",
+            "SELECT COUNT(DISTINCT team_id) FROM flag_submissions WHERE task_id=?",
+            "SELECT author, text, created_time FROM submission_comments WHERE team_id = ? AND task_id = ?",
+            "SELECT * FROM users WHERE permanent_id = ?",
+        ]:
+            self.assertEqual(board.queryplans.full_scans(db, sql), [], sql)
+
+    def test_query_profiler(self):
+        app.app.config["PROFILE_DB"] = True
+        app.app.config["PROFILE_DB_SAMPLE_RATE"] = 1
+        self.addCleanup(app.app.config.update, PROFILE_DB=False)
+        board.profiler.reset_profile_stats()
+        self.assertEqual(board.profiler.normalize_sql("SELECT * FROM t WHERE a = 5 AND b IN (?, ?,?) AND c='x'"),
+                "SELECT * FROM t WHERE a = ? AND b IN (?, ...) AND c=?")
+        with app.app.test_client() as client:
+            self.log_me_in(client, "admin", "admin")
+            client.get("/scoreboard")
+            rv = client.get("/profiler/json")
+            stats = {s["endpoint"]: s for s in rv.get_json()["endpoints"]}
+            self.assertGreater(stats["scoreboard"]["queries"]["max"], 0)
+            self.assertTrue(any(s["sql"].startswith("SELECT version") for s in stats["scoreboard"]["statements"]))
+            rv = client.get("/profiler/")
+            self.assertIn(b"scoreboard", rv.data)
+
+    def test_n_plus_one_detector(self):
+        flask.g._db_profile = profile = board.profiler.RequestProfile(track_callers=True)
+        try:
+            for member in board.util.get_team_members(1):
+                board.util.get_user_name(member)
+            for user_id in range(1, 4):
+                board.util.get_user_name(user_id)
+        finally:
+            del flask.g._db_profile
+        repeated = profile.repeated_statements(5)
+        self.assertEqual(len(repeated), 1)
+        sql, count, sites = repeated[0]
+        self.assertIn("FROM users u WHERE u.id = ?", sql)
+        self.assertEqual(count, 5)
+        self.assertIn("(get_user_name) <- tests.py:", board.profiler.format_call_site(sites.most_common(1)[0][0]))
+
+    def test_query_budgets(self):
+        budgets = {"scoreboard": 3, "tasks.tasks": 3, "tasks.task_detail": 6, "team": 4, "taskadmin.task_overview": 2}
+        with app.app.test_client() as client:
+            self.log_me_in(client, "testc", "testc")
+            with board.profiler.count_queries() as profiles:
+                for url in ["/scoreboard", "/tasks/", "/tasks/1", "/team"]:
+                    client.get(url)
+            self.logout(client)
+            self.log_me_in(client, "admin", "admin")
+            with board.profiler.count_queries() as admin_profiles:
+                client.get("/taskadmin/")
+        self.assertEqual([p.endpoint for p in profiles + admin_profiles], list(budgets))
+        for p in profiles + admin_profiles:
+            self.assertLessEqual(p.queries, budgets[p.endpoint], p.endpoint)
+
+    def test_task_overview_stats(self):
+        cur = app.get_db().cursor()
+        cur.execute("""INSERT INTO tasks (task_id, task_short, task_long, from_date, due_date, needed, order_num, max_points) VALUES (2, '2', 'Other', 0, 0, 0, 2, 3)""")
+        cur.executemany("INSERT INTO task_submissions (task_id, team_id, user_id, submission_time, filepath, original_name) VALUES (1, ?, ?, 0, '', '')", [(1, 3), (1, 4), (2, 1)])
+        cur.executemany("INSERT INTO flag_submissions (task_id, team_id, user_id, flag, flag_time, submission_time) VALUES (1, ?, 1, ?, 0, 0)", [(1, "a"), (1, "b"), (2, "c")])
+        cur.executemany("INSERT INTO task_grading (task_id, team_id, comment, internal_comment, points, corrector, created_time, deleted_time) VALUES (1, ?, '', '', ?, '', 0, ?)",
+                [(1, 5, None), (1, 2, 1), (2, 2, None)])
+        cur.executemany("INSERT INTO task_feedback (task_id, user_id, rating) VALUES (1, ?, ?)", [(1, 2), (2, 4)])
+
+        stats = {t["task_id"]: t for t in board.taskadmin.get_task_overview()}
+        self.assertEqual([stats[1][k] for k in ["submissions_received", "flags_received", "grading_done", "full_points", "avg_rating", "number_of_ratings"]],
+                [2, 2, 2, 1, 3, 2])
+        self.assertEqual([stats[2][k] for k in ["submissions_received", "flags_received", "grading_done", "full_points", "avg_rating", "number_of_ratings"]],
+                [0, 0, 0, 0, None, 0])
+
+        # Counters maintained by the triggers match a recomputation after updates and deletes as well
+        cur.execute("UPDATE task_grading SET deleted_time = 1 WHERE task_id = 1 AND team_id = 2 AND deleted_time IS NULL")
+        cur.execute("UPDATE tasks SET max_points = 2 WHERE task_id = 1")
+        cur.execute("DELETE FROM task_feedback WHERE user_id = 1")
+        cur.execute("DELETE FROM flag_submissions WHERE flag = 'a'")
+        self.assertEqual(board.taskstats.check_task_stats(), [])
+        cur.execute("UPDATE task_stats SET gradings = 42")
+        self.assertEqual(len(board.taskstats.check_task_stats()), 2)
+        board.taskstats.rebuild_task_stats()
+        self.assertEqual(board.taskstats.check_task_stats(), [])
+
+    def test_compare_grades(self):
+        db_grades = [
+            {"task_short": "1", "team_id": 1, "comment": "ok", "internal_comment": "", "points": 5.0, "corrector": "a"},
+            {"task_short": "1", "team_id": 2, "comment": "ok", "internal_comment": "", "points": 5.0, "corrector": "a"},
+        ]
+        csv_grades = [("1", 1, "ok", "", 5.0, "a"), ("1", 2, "ok", "", 4.0, "a"), ("2", 1, "new", "", 1.0, "b")]
+        self.assertEqual(board.gradeupload.compare_grades(db_grades, csv_grades), [
+            ("m", ("1", 2, "ok", "", 4.0, "a"), ("1", 2, "ok", "", 5.0, "a")),
+            ("n", ("2", 1, "new", "", 1.0, "b"), None),
+        ])
+
+    def test_grade_import_changeset(self):
+        gradecsv = b"team;task;points;comment;internal_comment;corrector\n1;1;2,5;Gut;;Fabian\n"
+        with app.app.test_client() as client:
+            self.log_me_in(client, "admin", "admin")
+            rv = client.post("/grade-upload", data={"gradefile": (io.BytesIO(gradecsv), "grading.csv")})
+            self.assertIn(b"Neue Benotungen: 1", rv.data)
+            changeset = re.search(b'value="([^"]*)" name="changeset"', rv.data).group(1)
+            self.assertEqual(len(changeset), 32)
+            rv = client.post("/grade-upload", data={"changeset": changeset})
+            self.assertIn(b"Benotung importiert! 1 neue und 0 ge", rv.data)
+            # Changesets can only be imported once
+            rv = client.post("/grade-upload", data={"changeset": changeset})
+            self.assertIn(b"abgelaufen", rv.data)
+
+            rv = client.post("/grade-upload", data={"gradefile": (io.BytesIO(gradecsv.replace(b"2,5", b"3")), "grading.csv")})
+            changeset = re.search(b'value="([^"]*)" name="changeset"', rv.data).group(1)
+            rv = client.post("/grade-upload", data={"changeset": changeset})
+            self.assertIn(b"Benotung importiert! 0 neue und 1 ge", rv.data)
+
+            # The task was renamed after the diff step
+            rv = client.post("/grade-upload", data={"gradefile": (io.BytesIO(gradecsv.replace(b"2,5", b"4")), "grading.csv")})
+            changeset = re.search(b'value="([^"]*)" name="changeset"', rv.data).group(1)
+            app.get_db().execute("UPDATE tasks SET task_short = '1a' WHERE task_id = 1")
+            rv = client.post("/grade-upload", data={"changeset": changeset})
+            self.assertEqual(rv.status_code, 200)
+            self.assertIn(b"Task 1 exisistiert nicht mehr", rv.data)
+        grades = app.get_db().execute("SELECT points, deleted_time IS NULL FROM task_grading WHERE task_id = 1 AND team_id = 1 ORDER BY id").fetchall()
+        self.assertEqual([tuple(g) for g in grades], [(2.5, 0), (3.0, 1)])
+
+    def test_grade_download(self):
+        app.create_team([1, 2])
+        cur = app.get_db().cursor()
+        cur.executemany("INSERT INTO task_grading (task_id, team_id, comment, internal_comment, points, corrector, created_time, deleted_time) VALUES (1, ?, ?, '', ?, ?, 0, ?)",
+                [(1, "Gut; sehr gut", 5, "Fabian", None), (2, "", 2.5, "Anna", None), (2, "alt", 1, "Anna", 1)])
+        with app.app.test_client() as client:
+            self.log_me_in(client, "admin", "admin")
+            rv = client.get("/grade-upload/dl")
+            self.assertEqual(rv.mimetype, "text/csv")
+            self.assertEqual(rv.data.decode().splitlines(), [
+                "task;team;points;comment;internal_comment;corrector",
+                '1;1;5.0;"Gut; sehr gut";;Fabian',
+                "1;2;2.5;;;Anna",
+            ])
+            rv = client.get("/grade-upload/dl?corrector=Anna&task=1")
+            self.assertEqual(rv.data.decode().splitlines()[1:], ["1;2;2.5;;;Anna"])
+            rv = client.get("/grade-upload/dl?team=1&team=3")
+            self.assertEqual(len(rv.data.decode().splitlines()), 2)
+            self.assertEqual(client.get("/grade-upload/dl?team=x").status_code, 400)
+
+    def test_submissions_zip(self):
+        due = app.get_db().execute("SELECT due_date FROM tasks WHERE task_id = 1").fetchone()[0]
+        with tempfile.TemporaryDirectory() as d:
+            rows = []
+            for i, (team, time_offset) in enumerate([(1, -20), (1, -10), (2, -5), (2, 10)]):
+                path = f"{d}/sub{i}.zip"
+                with open(path, "wb") as f:
+                    f.write(b"PK" + bytes([i]) * 1000)
+                rows.append((team, due + time_offset, path))
+            rows.append((1, due - 30, f"{d}/missing.zip"))
+            app.get_db().executemany("INSERT INTO task_submissions (task_id, team_id, user_id, submission_time, filepath, original_name) VALUES (1, ?, 1, ?, ?, 'x.zip')", rows)
+
+            with app.app.test_client() as client:
+                self.log_me_in(client, "admin", "admin")
+                rv = client.get("/taskadmin/dl")
+                self.assertTrue(rv.is_streamed)
+                with zipfile.ZipFile(io.BytesIO(rv.data)) as z:
+                    self.assertEqual(z.namelist(), ["1/team-1/1-x.zip", "1/team-1/2-x.zip", "1/team-2/3-x.zip", "1/team-2/4-x.zip"])
+                    self.assertEqual(z.read("1/team-2/3-x.zip"), b"PK" + b"\x02" * 1000)
+                rv = client.get("/taskadmin/dl?task=1&latest=1&due=task")
+                with zipfile.ZipFile(io.BytesIO(rv.data)) as z:
+                    self.assertEqual(z.namelist(), ["1/team-1/2-x.zip", "1/team-2/3-x.zip"])
+                rv = client.get("/taskadmin/dl?task=2")
+                self.assertEqual(rv.headers["Content-Disposition"], "attachment; filename=submissions-2.zip")
+                with zipfile.ZipFile(io.BytesIO(rv.data)) as z:
+                    self.assertEqual(z.namelist(), [])
+                rv = client.get("/taskadmin/dl", query_string={"task": 'x y";z'})
+                self.assertEqual(rv.headers["Content-Disposition"], "attachment; filename=submissions-x_y__z.zip")
+
+    def test_submission_storage(self):
+        cwd = os.getcwd()
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        os.chdir(d.name)
+        self.addCleanup(os.chdir, cwd)
+        os.mkdir("submissions")
+        app.get_db().execute("UPDATE tasks SET due_date = ? WHERE task_id = 1", (int(time.time()) + 3600,))
+
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as z:
+            z.writestr("exploit.py", "print(1)")
+        content = buf.getvalue()
+
+        with app.app.test_client() as client:
+            self.log_me_in(client, "testc", "testc")
+            for name in ["a.zip", "b.zip"]:
+                rv = client.post("/tasks/1/upload", data={"fileupload": (io.BytesIO(content), name)}, follow_redirects=True)
+                self.assertIn(b"erfolgreich entgegengenommen", rv.data)
+            rv = client.post("/tasks/1/upload", data={"fileupload": (io.BytesIO(b"no zip"), "c.zip")}, follow_redirects=True)
+            self.assertIn(b"keine ZIP-Datei", rv.data)
+            rv = client.get("/tasks/1/upload")
+            self.assertEqual(rv.data, content)
+
+        paths = [r[0] for r in app.get_db().execute("SELECT filepath FROM task_submissions")]
+        self.assertEqual(len(paths), 2)
+        self.assertEqual(paths[0], paths[1])
+        self.assertEqual(sorted(os.listdir(os.path.dirname(paths[0]))), [os.path.basename(paths[0])])
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(paths[0]).st_mode & 0o777, 0o666 & ~umask)
+
+        # Files from before the blob store are moved into it, identical ones only once
+        for name in ["old1.py", "old2.py"]:
+            with open(f"submissions/{name}", "w") as f:
+                f.write("print(1)")
+            app.get_db().execute("INSERT INTO task_submissions (task_id, team_id, user_id, submission_time, filepath, original_name) VALUES (1, 1, 3, 0, ?, ?)", (f"submissions/{name}", name))
+        results = list(board.submissions.migrate_submissions())
+        self.assertEqual([(r[0], r[2]) for r in results], [("submissions/old1.py", False), ("submissions/old2.py", True)])
+        self.assertFalse(os.path.exists("submissions/old1.py"))
+        rows = app.get_db().execute("SELECT DISTINCT filepath, sha256 FROM task_submissions WHERE original_name LIKE 'old%'").fetchall()
+        self.assertEqual(len(rows), 1)
+        with open(rows[0]["filepath"]) as f:
+            self.assertEqual(f.read(), "print(1)")
+
+    def test_submission_validation(self):
+        def validate(ext, data, max_size=None):
+            v = board.submissions.SubmissionValidator(ext, max_size)
+            for i in range(0, len(data), 7):
+                v.feed(data[i:i + 7])
+            v.close()
+
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w") as z:
+            z.writestr("a.txt", "a" * 100)
+            z.comment = b"comment"
+        content = buf.getvalue()
+        validate(".zip", content)
+        validate(".py", b"print(1)")
+        for ext, data, max_size in [(".zip", b"", None), (".zip", b"no zip", None), (".zip", content[:-30], None),
+                (".zip", content[:40] + content[60:], None), (".py", b"print(1)\0", None), (".py", b"x" * 10, 9)]:
+            with self.assertRaises(board.submissions.SubmissionRejected):
+                validate(ext, data, max_size)
+
+        cwd = os.getcwd()
+        d = tempfile.TemporaryDirectory()
+        self.addCleanup(d.cleanup)
+        os.chdir(d.name)
+        self.addCleanup(os.chdir, cwd)
+        app.get_db().execute("UPDATE tasks SET due_date = ? WHERE task_id = 1", (int(time.time()) + 3600,))
+        app.app.config["MAX_SUBMISSION_SIZE"] = 1024
+        self.addCleanup(app.app.config.pop, "MAX_SUBMISSION_SIZE")
+        with app.app.test_client() as client:
+            self.log_me_in(client, "testc", "testc")
+            rv = client.post("/tasks/1/upload", data={"fileupload": (io.BytesIO(b"x" * 2048), "a.zip")}, follow_redirects=True)
+            self.assertIn("zu groß".encode(), rv.data)
+            rv = client.post("/tasks/1/upload", data={"fileupload": (io.BytesIO(content[:-30]), "a.zip")}, follow_redirects=True)
+            self.assertIn("beschädigt".encode(), rv.data)
+        self.assertEqual(os.listdir("submissions/blobs"), [])
+        self.assertEqual(app.get_db().execute("SELECT COUNT(*) FROM task_submissions").fetchone()[0], 0)
+
+    def test_autograde_leases(self):
+        app.app.config["AUTOGRADE_APIKEY"] = "autograde-key"
+        self.addCleanup(app.app.config.update, AUTOGRADE_APIKEY=None)
+        db = app.get_db()
+        db.execute("UPDATE tasks SET autograded = 1 WHERE task_id = 1")
+        app.create_team([1, 2])
+        # Team 1 (users 3, 4) has two tasks in the queue, team 2 one
+        db.execute("""INSERT INTO tasks (task_id, task_short, task_long, markdown, markdown_rendered, from_date, due_date, needed, order_num, max_points, flag_key, autograded)
+            VALUES (2, '2', 'Second', '', '', 0, 0, 1, 2, 5, ?, 1)""", (board.util.create_flag_key(2),))
+        for i, (task_id, team_id, user_id) in enumerate([(1, 1, 3), (2, 1, 3), (1, 2, 1)], 1):
+            db.execute("INSERT INTO task_submissions (id, task_id, team_id, user_id, submission_time, filepath, original_name) VALUES (?, ?, ?, ?, ?, 'x', 'x.py')",
+                (i, task_id, team_id, user_id, i))
+
+        with app.app.test_client() as client:
+            def post(path, **data):
+                return client.post(f"/autograde/{path}?APIKEY=autograde-key", data=data)
+
+            self.assertEqual(client.post("/autograde/claim?APIKEY=wrong", data={"holder": "a"}).status_code, 403)
+            rv = post("claim", holder="a", limit=2)
+            # Team 2 gets its turn before team 1's second submission
+            self.assertEqual([s["id"] for s in rv.get_json()["submissions"]], [1, 3])
+            rv = post("claim", holder="b", limit=5)
+            self.assertEqual([s["id"] for s in rv.get_json()["submissions"]], [2])
+            self.assertEqual(post("claim", holder="b", limit=5).get_json()["submissions"], [])
+
+            self.assertEqual(post("heartbeat", holder="a", id=[1, 2, 3]).get_json()["held"], [1, 3])
+            # Released and expired leases are handed out again
+            post("release", holder="a", id=[3])
+            db.execute("UPDATE autograde_leases SET expires = 0 WHERE submission_id = 1")
+            self.assertEqual(post("heartbeat", holder="a", id=[1]).get_json()["held"], [])
+            rv = post("claim", holder="b", limit=5)
+            self.assertEqual([s["id"] for s in rv.get_json()["submissions"]], [1, 3])
+
+            # A grader whose lease was taken over can't overwrite the result
+            self.assertEqual(post("1", holder="a", output="no flag").status_code, 409)
+            rv = post("1", holder="b", output="no flag")
+            self.assertEqual(rv.get_json()["result"], "NO_FLAG")
+            self.assertEqual([r[0] for r in db.execute("SELECT submission_id FROM autograde_leases ORDER BY 1")], [2, 3])
+            self.assertEqual([s["id"] for s in client.get("/autograde/?APIKEY=autograde-key").get_json()], [2, 3])
+            self.log_me_in(client, "admin", "admin")
+            self.assertIn(b"Claimed by:</b> b", client.get("/autograde/queue").data)
+
+    def test_autograde_long_poll(self):
+        app.app.config["AUTOGRADE_APIKEY"] = "autograde-key"
+        self.addCleanup(app.app.config.update, AUTOGRADE_APIKEY=None)
+        db = app.get_db()
+        db.execute("UPDATE tasks SET autograded = 1 WHERE task_id = 1")
+
+        def submit():
+            db.execute("INSERT INTO task_submissions (id, task_id, team_id, user_id, submission_time, filepath, original_name) VALUES (1, 1, 1, 3, 1, 'x', 'x.py')")
+            board.autograde.notify_new_submission()
+
+        with app.app.test_client() as client:
+            def claim(wait):
+                start = time.monotonic()
+                rv = client.post("/autograde/claim?APIKEY=autograde-key", data={"holder": "a", "wait": wait})
+                return [s["id"] for s in rv.get_json()["submissions"]], time.monotonic() - start
+
+            claimed, elapsed = claim(0.3)
+            self.assertEqual(claimed, [])
+            self.assertGreaterEqual(elapsed, 0.3)
+
+            timer = threading.Timer(0.2, submit)
+            timer.start()
+            self.addCleanup(timer.cancel)
+            claimed, elapsed = claim(10)
+            self.assertEqual(claimed, [1])
+            self.assertLess(elapsed, 5)
+
+    def test_autograde_queue(self):
+        app.app.config["AUTOGRADE_APIKEY"] = "autograde-key"
+        self.addCleanup(app.app.config.update, AUTOGRADE_APIKEY=None)
+        db = app.get_db()
+        db.execute("UPDATE tasks SET autograded = 1 WHERE task_id = 1")
+        def submit(id):
+            db.execute("INSERT INTO task_submissions (id, task_id, team_id, user_id, submission_time, filepath, original_name) VALUES (?, 1, 1, 3, ?, 'x', 'x.py')", (id, id))
+        def queue():
+            return [r["id"] for r in board.autograde.get_submission_queue()]
+        def result(id):
+            return db.execute("SELECT autograde_result FROM task_submissions WHERE id = ?", (id,)).fetchone()[0]
+
+        submit(1)
+        self.assertEqual(queue(), [1])
+        # A later upload replaces the queued submission, which is canceled
+        submit(2)
+        self.assertEqual(queue(), [2])
+        self.assertEqual(result(1), board.autograde.AutogradeStatus.CANCELED.value)
+
+        with app.app.test_client() as client:
+            # A result for the canceled submission arriving late doesn't count
+            rv = client.post("/autograde/1?APIKEY=autograde-key", data={"output": "no flag"})
+            self.assertEqual(rv.get_json()["result"], "CANCELED")
+            self.assertEqual(db.execute("SELECT COUNT(*) FROM task_grading").fetchone()[0], 0)
+            client.post("/autograde/2?APIKEY=autograde-key", data={"output": "no flag"})
+        self.assertEqual(queue(), [])
+        self.assertEqual(result(2), board.autograde.AutogradeStatus.NO_FLAG.value)
+
+        submit(3)
+        db.execute("UPDATE tasks SET autograded = 0 WHERE task_id = 1")
+        self.assertEqual(queue(), [])
+        submit(4)
+        self.assertIsNone(result(3))
+        db.execute("UPDATE tasks SET autograded = 1 WHERE task_id = 1")
+        self.assertEqual(queue(), [4])
+
     def test_healthcheck_post(self):
         with app.app.test_client() as client:
             rv = client.post("/tasks/status/update", data={"APIKEY": app.app.config["TASK_STATUS_APIKEY"], "output": self.testflag})